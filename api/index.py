@@ -1,20 +1,334 @@
+from __future__ import annotations
+
+import time
+
+_module_load_started = time.perf_counter()
+
+import asyncio
+import bisect
+import functools
+import json
 import logging
+import os
 import sqlite3
-from datetime import datetime
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler
+from typing import TYPE_CHECKING
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+# telegram.ext (вместе с APScheduler) импортируется в build_application(): он не нужен
+# для health-check, утилит командной строки и замера старта. Для аннотаций обработчиков он
+# нужен только анализаторам типов: благодаря `from __future__ import annotations` они не вычисляются
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
 
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# Очередь outbox запускается каждую секунду - без этого APScheduler пишет в лог о каждом запуске
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
-# Инициализация базы данных
-def init_db():
-    conn = sqlite3.connect('shower_bot.db')
-    cursor = conn.cursor()
+BOT_TOKEN = os.environ.get('BOT_TOKEN')
+# Обязателен в webhook-режиме: без него любой может прислать на публичный адрес поддельный update
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+# На Vercel писать можно только в /tmp, и он не переживает пересоздание инстанса,
+# поэтому там локальный файл - лишь реплика базы из LIBSQL_URL
+DB_PATH = os.environ.get('DB_PATH') or ('/tmp/shower_bot.db' if os.environ.get('VERCEL') else 'shower_bot.db')
+LIBSQL_URL = os.environ.get('LIBSQL_URL')
+LIBSQL_AUTH_TOKEN = os.environ.get('LIBSQL_AUTH_TOKEN')
+
+# Размер кэша подготовленных выражений на одно соединение
+STATEMENT_CACHE_SIZE = 64
+
+class ConnectionManager:
+    """Держит по одному долгоживущему соединению на поток вместо connect/close на каждый запрос"""
+    
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-8000',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA busy_timeout=5000',
+    )
     
+    def __init__(self, path, sync_url=None, auth_token=None):
+        self.path = path
+        self.sync_url = sync_url
+        self.auth_token = auth_token
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        # Нарушение ограничения (UNIQUE): libSQL поднимает для него ValueError, а не IntegrityError
+        self.integrity_errors = (sqlite3.IntegrityError, ValueError) if sync_url else (sqlite3.IntegrityError,)
+    
+    def _connect(self):
+        if self.sync_url:
+            # Встроенная реплика libSQL: чтения из локального файла, записи уходят в основную базу
+            import libsql_experimental as libsql
+            conn = libsql.connect(self.path, sync_url=self.sync_url, auth_token=self.auth_token)
+            conn.sync()
+            return conn
+        
+        conn = sqlite3.connect(
+            self.path,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False,
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    
+    def refresh(self):
+        """Подтягивает изменения, сделанные другими процессами или инстансами.
+        Возвращает True, если данные в базе могли измениться"""
+        conn = self.connection()
+        if self.sync_url:
+            # Кадры репликации применяет отдельное соединение, поэтому data_version
+            # этого соединения изменится, только если sync() действительно что-то принёс
+            conn.sync()
+        # data_version меняется только после коммитов через другие соединения
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        changed = version != getattr(self._local, 'data_version', version)
+        self._local.data_version = version
+        return changed
+    
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+db = ConnectionManager(DB_PATH, LIBSQL_URL, LIBSQL_AUTH_TOKEN)
+
+# Метрики выключены по умолчанию; выключенные, они не оборачивают ни одной функции
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == '1'
+# Период записи снимка метрик в лог в режиме polling, секунд (0 - не писать)
+METRICS_LOG_INTERVAL = int(os.environ.get('METRICS_LOG_INTERVAL', '0'))
+# Порт для /metrics в режиме polling (в webhook-режиме /metrics отдаёт handler)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+
+class Metrics:
+    """Счётчики вызовов, гистограммы задержек и число затронутых строк"""
+    
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    
+    # вид серии -> (имя метрики Prometheus, имя метки)
+    KINDS = {
+        'handler': ('shower_handler', 'handler'),
+        'db': ('shower_db_helper', 'helper'),
+        'lock_wait': ('shower_db_lock_wait', 'stage'),
+    }
+    # вид счётчика -> (имя метрики Prometheus, имя метки)
+    COUNTERS = {
+        'user_cache': ('shower_user_cache_total', 'result'),
+        'updates': ('shower_updates_total', 'result'),
+        'rate_limit': ('shower_rate_limited_total', 'result'),
+    }
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._counters = {}
+    
+    def count(self, kind, name, value=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._counters[(kind, name)] = self._counters.get((kind, name), 0) + value
+    
+    def observe(self, kind, name, seconds, rows=0, error=False):
+        with self._lock:
+            series = self._series.get((kind, name))
+            if series is None:
+                series = self._series[(kind, name)] = {
+                    'count': 0, 'sum': 0.0, 'rows': 0, 'errors': 0,
+                    'buckets': [0] * len(self.BUCKETS),
+                }
+            series['count'] += 1
+            series['sum'] += seconds
+            series['rows'] += rows
+            series['errors'] += error
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    series['buckets'][i] += 1
+                    break
+    
+    def snapshot(self):
+        with self._lock:
+            result = {
+                f'{kind}:{name}': {
+                    'count': s['count'], 'errors': s['errors'], 'rows': s['rows'],
+                    'avg_ms': round(s['sum'] / s['count'] * 1000, 2) if s['count'] else 0.0,
+                }
+                for (kind, name), s in sorted(self._series.items())
+            }
+            result.update((f'{kind}:{name}', value) for (kind, name), value in sorted(self._counters.items()))
+            return result
+    
+    def render_prometheus(self):
+        """Текстовый формат экспозиции Prometheus"""
+        with self._lock:
+            series = sorted(self._series.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        for kind, (metric, label) in self.KINDS.items():
+            rows = [(name, s) for (k, name), s in series if k == kind]
+            if not rows:
+                continue
+            lines.append(f'# TYPE {metric}_seconds histogram')
+            for name, s in rows:
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, s['buckets']):
+                    cumulative += count
+                    lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="+Inf"}} {s["count"]}')
+                lines.append(f'{metric}_seconds_sum{{{label}="{name}"}} {s["sum"]:.6f}')
+                lines.append(f'{metric}_seconds_count{{{label}="{name}"}} {s["count"]}')
+            if kind == 'lock_wait':
+                continue
+            lines.append(f'# TYPE {metric}_errors_total counter')
+            lines.extend(f'{metric}_errors_total{{{label}="{name}"}} {s["errors"]}' for name, s in rows)
+            if kind == 'db':
+                lines.append(f'# TYPE {metric}_rows_total counter')
+                lines.extend(f'{metric}_rows_total{{{label}="{name}"}} {s["rows"]}' for name, s in rows)
+        for kind, (metric, label) in self.COUNTERS.items():
+            rows = [(name, value) for (k, name), value in counters if k == kind]
+            if rows:
+                lines.append(f'# TYPE {metric} counter')
+                lines.extend(f'{metric}{{{label}="{name}"}} {value}' for name, value in rows)
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def instrumented_db(func):
+    """Замеряет хелпер БД: задержку и число строк (прочитанных списком или изменённых)"""
+    if not METRICS_ENABLED:
+        return func
+    
+    @functools.wraps(func)
+    def wrapper(*args):
+        conn = get_db_connection()
+        # У соединения libSQL нет total_changes - там считаются только прочитанные списки
+        changes_before = getattr(conn, 'total_changes', 0)
+        started = time.perf_counter()
+        error = False
+        result = None
+        try:
+            result = func(*args)
+            return result
+        except Exception:
+            error = True
+            raise
+        finally:
+            # Для записей - изменённые строки, для чтений - размер прочитанного списка
+            rows = getattr(conn, 'total_changes', 0) - changes_before
+            if not rows and isinstance(result, list):
+                rows = len(result)
+            metrics.observe('db', func.__name__, time.perf_counter() - started, rows, error)
+    return wrapper
+
+def instrumented_handler(callback):
+    """Замеряет обработчик Telegram целиком, вместе с ожиданием БД и Bot API.
+    Вложенные обработчики (show_* из главного меню) замеряются отдельно"""
+    if not METRICS_ENABLED:
+        return callback
+    
+    @functools.wraps(callback)
+    async def wrapper(*args):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await callback(*args)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.observe('handler', callback.__name__, time.perf_counter() - started, error=error)
+    return wrapper
+
+def begin_immediate(cursor):
+    """BEGIN IMMEDIATE с замером ожидания блокировки на запись (busy_timeout)"""
+    if not METRICS_ENABLED:
+        cursor.execute('BEGIN IMMEDIATE')
+        return
+    started = time.perf_counter()
+    cursor.execute('BEGIN IMMEDIATE')
+    metrics.observe('lock_wait', 'begin_immediate', time.perf_counter() - started)
+
+# 'async' - запросы выполняются в потоках вне цикла событий, 'sync' - прямо в обработчике
+DB_BACKEND = os.environ.get('DB_BACKEND', 'async')
+DB_READ_WORKERS = int(os.environ.get('DB_READ_WORKERS', '4'))
+
+class DBExecutor:
+    """Выполняет синхронные хелперы БД вне цикла событий: чтения в пуле потоков,
+    записи в единственном потоке-писателе, чтобы они не конкурировали за блокировку"""
+    
+    def __init__(self, backend, read_workers):
+        self.backend = backend
+        self.read_workers = read_workers
+        self._readers = None
+        self._writer = None
+    
+    async def _run(self, pool, func, args):
+        if self.backend == 'sync':
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, functools.partial(func, *args))
+    
+    async def read(self, func, *args):
+        if self._readers is None and self.backend != 'sync':
+            from concurrent.futures import ThreadPoolExecutor
+            self._readers = ThreadPoolExecutor(self.read_workers, thread_name_prefix='db-read')
+        return await self._run(self._readers, func, args)
+    
+    async def write(self, func, *args):
+        if self._writer is None and self.backend != 'sync':
+            from concurrent.futures import ThreadPoolExecutor
+            self._writer = ThreadPoolExecutor(1, thread_name_prefix='db-write')
+        if METRICS_ENABLED and self.backend != 'sync':
+            func = self._timed_queue_wait(func)
+        return await self._run(self._writer, func, args)
+    
+    @staticmethod
+    def _timed_queue_wait(func):
+        # Время, которое запись провела в очереди к потоку-писателю
+        queued = time.perf_counter()
+        
+        def run(*args):
+            metrics.observe('lock_wait', 'writer_queue', time.perf_counter() - queued)
+            return func(*args)
+        return run
+    
+    def shutdown(self):
+        for pool in (self._readers, self._writer):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self._readers = self._writer = None
+
+db_executor = DBExecutor(DB_BACKEND, DB_READ_WORKERS)
+
+async def db_read(func, *args):
+    return await db_executor.read(func, *args)
+
+async def db_write(func, *args):
+    return await db_executor.write(func, *args)
+
+def _migration_1(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -35,155 +349,947 @@ def init_db():
         )
     ''')
     
-    conn.commit()
-    conn.close()
+    # Одна кабинка на одно время: убираем возможные дубли, оставшиеся до появления ограничения
+    cursor.execute('''
+        DELETE FROM bookings
+        WHERE id NOT IN (SELECT MIN(id) FROM bookings GROUP BY time, cabin_number)
+    ''')
+    # Уникальный индекс заодно служит индексом по time для выборок и очистки
+    cursor.execute('DROP INDEX IF EXISTS idx_bookings_time')
+    cursor.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_slot ON bookings (time, cabin_number)'
+    )
+
+def _migration_2(cursor):
+    # time 'ЧЧ:ММ' -> настоящая дата + минута от начала суток. Старые брони не знают даты,
+    # но все они ещё не прошли (прошедшие удалялись), поэтому относятся к сегодняшнему дню
+    cursor.execute('''
+        CREATE TABLE bookings_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            cabin_number INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO bookings_v2 (id, user_id, date, slot, cabin_number, created_at)
+        SELECT id, user_id, date('now', 'localtime'),
+               CAST(substr(time, 1, 2) AS INTEGER) * 60 + CAST(substr(time, 4, 2) AS INTEGER),
+               cabin_number, created_at
+        FROM bookings
+    ''')
+    cursor.execute('DROP TABLE bookings')
+    cursor.execute('ALTER TABLE bookings_v2 RENAME TO bookings')
+    
+    # Расписание и очистка - диапазоны по (date, slot), брони пользователя - по (user_id, date, slot)
+    cursor.execute(
+        'CREATE UNIQUE INDEX idx_bookings_slot ON bookings (date, slot, cabin_number)'
+    )
+    cursor.execute('CREATE INDEX idx_bookings_user ON bookings (user_id, date, slot)')
+
+def _migration_3(cursor):
+    # Длительность брони в минутах; уже существующие брони получают прежние 15 минут
+    cursor.execute('ALTER TABLE bookings ADD COLUMN duration INTEGER NOT NULL DEFAULT 15')
+
+def _migration_4(cursor):
+    # Брони и пользователи привязываются к душевой; прежние - к душевой по умолчанию.
+    # Индекс слотов начинается с facility, чтобы выборки одной душевой не задевали чужие брони
+    cursor.execute('ALTER TABLE users ADD COLUMN facility TEXT')
+    cursor.execute("ALTER TABLE bookings ADD COLUMN facility TEXT NOT NULL DEFAULT ''")
+    cursor.execute('UPDATE users SET facility = ?', (DEFAULT_FACILITY.id,))
+    cursor.execute('UPDATE bookings SET facility = ?', (DEFAULT_FACILITY.id,))
+    cursor.execute('DROP INDEX idx_bookings_slot')
+    cursor.execute(
+        'CREATE UNIQUE INDEX idx_bookings_slot ON bookings (facility, date, slot, cabin_number)'
+    )
+
+def _migration_5(cursor):
+    # Очередь исходящих сообщений (напоминания, рассылки); not_before - unix-время
+    cursor.execute('''
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            not_before REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_outbox_due ON outbox (not_before)')
+    
+    # Напоминание о брони ставится в очередь один раз; частичный индекс хранит
+    # только ещё не напомненные брони, поэтому поиск ближайших не сканирует остальные
+    cursor.execute('ALTER TABLE bookings ADD COLUMN reminded INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('CREATE INDEX idx_bookings_remind ON bookings (date, slot) WHERE reminded = 0')
+
+def _migration_6(cursor):
+    # Состояние диалога (context.user_data / chat_data) компактным JSON; kind - 'user' или 'chat'
+    cursor.execute('''
+        CREATE TABLE conversation_state (
+            kind TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (kind, id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_7(cursor):
+    # Архив закончившихся броней: только добавление; пол - на момент архивации
+    cursor.execute('''
+        CREATE TABLE bookings_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            facility TEXT NOT NULL,
+            date TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            duration INTEGER NOT NULL,
+            cabin_number INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Сводка загрузки: брони (по часу начала) и занятые минуты кабинок по часам дня,
+    # дням недели (0 - понедельник) и полу; пополняется при архивации
+    cursor.execute('''
+        CREATE TABLE utilisation (
+            facility TEXT NOT NULL,
+            weekday INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            bookings INTEGER NOT NULL DEFAULT 0,
+            minutes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (facility, weekday, hour, gender)
+        ) WITHOUT ROWID
+    ''')
+
+# Версия схемы = количество применённых миграций, хранится в PRAGMA user_version
+MIGRATIONS = [_migration_1, _migration_2, _migration_3, _migration_4, _migration_5, _migration_6, _migration_7]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Инициализация базы данных
+def init_db():
+    conn = get_db_connection()
+    
+    # Схема уже актуальна - обходимся чтением заголовка файла, без DDL
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        return
+    
+    cursor = conn.cursor()
+    begin_immediate(cursor)
+    try:
+        # Перечитываем под блокировкой: другой процесс мог успеть мигрировать раньше
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        for number in range(version, SCHEMA_VERSION):
+            MIGRATIONS[number](cursor)
+            cursor.execute(f'PRAGMA user_version = {number + 1}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 def get_db_connection():
-    return sqlite3.connect('shower_bot.db')
+    return db.connection()
 
+# Профили (пол, имя, душевая) меняются редко, а читаются на каждой проверке доступности
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '5000'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '300'))
+
+class UserCache:
+    """LRU-кэш профилей с временем жизни записи. Хранит и None для незарегистрированных.
+    Вызывается из потоков пула чтения, поэтому под блокировкой"""
+    
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # user_id -> (когда запись устареет по time.monotonic(), профиль или None)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Растёт при каждой инвалидации: профиль, прочитанный до неё, в кэш не кладётся
+        self.generation = 0
+    
+    def get(self, user_id):
+        """(найден ли в кэше, профиль)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                metrics.count('user_cache', 'hit')
+                return True, entry[1]
+        metrics.count('user_cache', 'miss')
+        return False, None
+    
+    def put(self, user_id, user, generation):
+        if self.size <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                metrics.count('user_cache', 'evicted')
+    
+    def invalidate(self, user_id):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(user_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+@instrumented_db
 def get_user(user_id):
+    found, user = user_cache.get(user_id)
+    if found:
+        return user
+    
+    generation = user_cache.generation
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    cursor.execute('SELECT user_id, gender, name, facility FROM users WHERE user_id = ?', (user_id,))
+    row = cursor.fetchone()
     
-    if user:
-        return {'user_id': user[0], 'gender': user[1], 'name': user[2]}
-    return None
+    user = {'user_id': row[0], 'gender': row[1], 'name': row[2], 'facility': row[3]} if row else None
+    user_cache.put(user_id, user, generation)
+    return user
 
+@instrumented_db
 def save_user(user_id, gender, name):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        'INSERT OR REPLACE INTO users (user_id, gender, name) VALUES (?, ?, ?)',
-        (user_id, gender, name)
-    )
+    begin_immediate(cursor)
+    try:
+        cursor.execute('SELECT gender, name FROM users WHERE user_id = ?', (user_id,))
+        previous = cursor.fetchone()
+        # Upsert, а не INSERT OR REPLACE: выбранная душевая должна сохраниться
+        cursor.execute('''
+            INSERT INTO users (user_id, gender, name) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET gender = excluded.gender, name = excluded.name
+        ''', (user_id, gender, name))
+        # Пол и имя участвуют в занятости и в расписании - но только душевых, где у пользователя
+        # есть брони. У нового пользователя броней нет, повторное нажатие ничего не меняет
+        affected = []
+        if previous is not None and tuple(previous) != (gender, name):
+            cursor.execute('SELECT DISTINCT facility FROM bookings WHERE user_id = ?', (user_id,))
+            affected = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    user_cache.invalidate(user_id)
+    for facility_id in affected:
+        if facility_id in FACILITIES:
+            FACILITIES[facility_id].occupancy.invalidate()
+
+@instrumented_db
+def set_user_facility(user_id, facility_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE users SET facility = ? WHERE user_id = ?', (facility_id, user_id))
     conn.commit()
-    conn.close()
+    user_cache.invalidate(user_id)
 
-def get_all_bookings():
+@instrumented_db
+def get_all_bookings(facility_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT b.time, b.cabin_number, u.gender, u.name 
-        FROM bookings b 
-        JOIN users u ON b.user_id = u.user_id 
-        ORDER BY b.time
-    ''')
+        SELECT b.date, b.slot, b.duration, b.cabin_number, u.gender, u.name
+        FROM bookings b
+        JOIN users u ON b.user_id = u.user_id
+        WHERE b.facility = ?
+        ORDER BY b.date, b.slot, b.cabin_number
+    ''', (facility_id,))
     bookings = cursor.fetchall()
-    conn.close()
     return bookings
 
+@instrumented_db
 def get_user_bookings(user_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT id, time, cabin_number 
-        FROM bookings 
-        WHERE user_id = ? 
-        ORDER BY time
+        SELECT id, facility, date, slot, duration, cabin_number
+        FROM bookings
+        WHERE user_id = ?
+        ORDER BY date, slot
     ''', (user_id,))
     bookings = cursor.fetchall()
-    conn.close()
     return bookings
 
+@instrumented_db
 def get_booking_owner(booking_id):
     """Получить user_id владельца бронирования"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT user_id FROM bookings WHERE id = ?', (booking_id,))
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else None
 
-def create_booking(user_id, time, cabin_number):
+# Насколько вперёд можно бронировать, дней
+BOOKING_DAYS_AHEAD = int(os.environ.get('BOOKING_DAYS_AHEAD', '7'))
+# Длительность новой брони, минут; должна быть меньше суток
+BOOKING_DURATION = int(os.environ.get('BOOKING_DURATION', '15'))
+# Сколько ближайших свободных времён предлагать, если выбранное занято, и с каким шагом, минут
+SUGGESTION_COUNT = int(os.environ.get('SUGGESTION_COUNT', '3'))
+SUGGESTION_STEP = int(os.environ.get('SUGGESTION_STEP', '5'))
+MINUTES_PER_DAY = 24 * 60
+
+def current_slot(now=None):
+    """Текущий момент как (дата ISO, минута от начала суток)"""
+    now = now or datetime.now()
+    return now.date().isoformat(), now.hour * 60 + now.minute
+
+def to_minute(date, slot):
+    """(дата ISO, слот) -> сквозная минута, чтобы сравнивать интервалы через полночь"""
+    return datetime.fromisoformat(date).toordinal() * MINUTES_PER_DAY + slot
+
+def from_minute(minute):
+    day, slot = divmod(minute, MINUTES_PER_DAY)
+    return datetime.fromordinal(day).date().isoformat(), slot
+
+def format_slot(slot):
+    return f"{slot // 60:02d}:{slot % 60:02d}"
+
+def format_when(date, slot, today=None):
+    """'сегодня 14:30', 'завтра 09:00' или '25.10 18:15'"""
+    today = today or datetime.now().date().isoformat()
+    if date == today:
+        day = "сегодня"
+    elif date == (datetime.fromisoformat(today) + timedelta(days=1)).date().isoformat():
+        day = "завтра"
+    else:
+        day = f"{date[8:10]}.{date[5:7]}"
+    return f"{day} {format_slot(slot)}"
+
+def format_span(date, slot, duration, today=None):
+    """'сегодня 14:30–14:45'"""
+    return f"{format_when(date, slot, today)}–{format_slot((slot + duration) % MINUTES_PER_DAY)}"
+
+def parse_when(text, now=None):
+    """Разбирает 'ЧЧ:ММ' или 'ДД.ММ ЧЧ:ММ' в (дата ISO, минута от начала суток).
+    Время без даты - ближайшее такое: сегодня, а если уже прошло - завтра. None, если формат неверный"""
+    now = now or datetime.now()
+    parts = text.split()
+    try:
+        moment = datetime.strptime(parts[-1], "%H:%M")
+        slot = moment.hour * 60 + moment.minute
+        if len(parts) == 1:
+            day = now.date()
+            if slot < now.hour * 60 + now.minute:
+                day += timedelta(days=1)
+        elif len(parts) == 2:
+            day_of_month, month = (int(p) for p in parts[0].split('.'))
+            day = datetime(now.year, month, day_of_month).date()
+            # Дата без года, которая в этом году уже прошла, - это следующий год
+            if day < now.date():
+                day = datetime(now.year + 1, month, day_of_month).date()
+        else:
+            return None
+    except ValueError:
+        return None
+    return day.isoformat(), slot
+
+# Число кабинок (ключей) в душевой по умолчанию, нумеруются с 1
+CABIN_COUNT = int(os.environ.get('CABIN_COUNT', '2'))
+# Метка пола, если в интервале уже есть брони разных полов
+MIXED_GENDERS = 'mixed'
+
+# Занятость кабинок хранится битовой маской: бит cabin - 1 установлен, если кабинка занята
+def cabin_bit(cabin):
+    return 1 << (cabin - 1)
+
+def merge_gender(tag, gender):
+    """Метка пола интервала после добавления ещё одной брони"""
+    return gender if tag in (None, gender) else MIXED_GENDERS
+
+def keys_word(count):
+    """'ключ', 'ключа' или 'ключей' для числа count"""
+    if count % 10 == 1 and count % 100 != 11:
+        return "ключ"
+    if 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        return "ключа"
+    return "ключей"
+
+class OccupancyIndex:
+    """Занятость кабинок душевой в памяти: по каждой кабинке - список интервалов [начало, конец)
+    в сквозных минутах, отсортированный по началу, чтобы пересечения искать бинарным поиском"""
+    
+    def __init__(self, facility_id, all_mask):
+        self.facility_id = facility_id
+        self._all_mask = all_mask
+        self._intervals = {}
+        self._by_id = {}
+        # (номер дня, пол) -> маска кабинок, свободных для этого пола, по минутам дня
+        self._free_maps = {}
+        # Самая длинная бронь в индексе: раньше start - _longest пересекающихся интервалов нет
+        self._longest = 0
+        self._loaded = False
+        self._lock = threading.RLock()
+        # Растёт при каждом изменении броней; по нему сбрасываются производные кэши
+        self.version = 0
+    
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            cursor = get_db_connection().cursor()
+            cursor.execute('''
+                SELECT b.id, b.date, b.slot, b.duration, b.cabin_number, u.gender
+                FROM bookings b
+                JOIN users u ON b.user_id = u.user_id
+                WHERE b.facility = ?
+            ''', (self.facility_id,))
+            for booking_id, date, slot, duration, cabin, gender in cursor.fetchall():
+                self._add(booking_id, date, slot, duration, cabin, gender)
+            self._loaded = True
+    
+    def _add(self, booking_id, date, slot, duration, cabin, gender):
+        start = to_minute(date, slot)
+        entry = (start, start + duration, booking_id, gender)
+        bisect.insort(self._intervals.setdefault(cabin, []), entry)
+        self._by_id[booking_id] = (cabin, entry)
+        self._longest = max(self._longest, duration)
+    
+    def busy(self, date, slot, duration):
+        """Возвращает (маска кабинок, занятых хотя бы часть интервала, метка пола или None)"""
+        self._ensure_loaded()
+        start = to_minute(date, slot)
+        end = start + duration
+        mask, gender = 0, None
+        with self._lock:
+            for cabin, intervals in self._intervals.items():
+                i = bisect.bisect_left(intervals, (start - self._longest + 1,))
+                # Пол нужен от каждого пересекающегося интервала, а не только от первого
+                while i < len(intervals) and intervals[i][0] < end:
+                    if intervals[i][1] > start:
+                        mask |= cabin_bit(cabin)
+                        gender = merge_gender(gender, intervals[i][3])
+                    i += 1
+        return mask, gender
+    
+    def add(self, booking_id, date, slot, duration, cabin, gender):
+        with self._lock:
+            # Читатель мог загрузить индекс между коммитом брони и этим вызовом -
+            # тогда бронь в нём уже есть, и второй копии быть не должно
+            if self._loaded and booking_id not in self._by_id:
+                self._add(booking_id, date, slot, duration, cabin, gender)
+                start = to_minute(date, slot)
+                for (day, map_gender), free in self._free_maps.items():
+                    self._mark(free, day, start, start + duration, cabin_bit(cabin), gender == map_gender)
+            self.version += 1
+    
+    def remove(self, booking_id):
+        with self._lock:
+            # Как и в add: даже если индекс не загружен, кэши поверх него (расписание) устарели
+            self.version += 1
+            entry = self._by_id.pop(booking_id, None)
+            if entry is None:
+                return
+            cabin, interval = entry
+            intervals = self._intervals[cabin]
+            del intervals[bisect.bisect_left(intervals, interval)]
+            # Освободившиеся минуты проще пересчитать: карты затронутых дней строятся заново при запросе
+            start, end = interval[0], interval[1]
+            for key in [k for k in self._free_maps if start // MINUTES_PER_DAY <= k[0] <= (end - 1) // MINUTES_PER_DAY]:
+                del self._free_maps[key]
+    
+    @staticmethod
+    def _mark(free, day, start, end, bit, same_gender):
+        """Отмечает в карте дня day занятость [start, end): у своего пола занята одна кабинка,
+        другому полу на это время недоступны все"""
+        day_start = day * MINUTES_PER_DAY
+        keep = ~bit if same_gender else 0
+        for minute in range(max(start, day_start) - day_start, min(end, day_start + MINUTES_PER_DAY) - day_start):
+            free[minute] &= keep
+    
+    def _free_map(self, day, gender):
+        """Карта свободных кабинок дня для пола: строится одним проходом по интервалам этого дня"""
+        free = self._free_maps.get((day, gender))
+        if free is None:
+            free = [self._all_mask] * MINUTES_PER_DAY
+            day_start = day * MINUTES_PER_DAY
+            for cabin, intervals in self._intervals.items():
+                i = bisect.bisect_left(intervals, (day_start - self._longest + 1,))
+                while i < len(intervals) and intervals[i][0] < day_start + MINUTES_PER_DAY:
+                    start, end, _, booking_gender = intervals[i]
+                    self._mark(free, day, start, end, cabin_bit(cabin), booking_gender == gender)
+                    i += 1
+            self._free_maps[(day, gender)] = free
+        return free
+    
+    def _fits(self, start, duration, gender):
+        # Нужна хотя бы одна кабинка, свободная для пола на всю длительность
+        usable = self._all_mask
+        for minute in range(start, start + duration):
+            day, offset = divmod(minute, MINUTES_PER_DAY)
+            usable &= self._free_map(day, gender)[offset]
+            if not usable:
+                return False
+        return True
+    
+    def suggest(self, date, slot, duration, gender, earliest, latest, count, step):
+        """До count ближайших к (date, slot) начал с шагом step, подходящих полу gender,
+        в пределах суток от запрошенного времени и [earliest, latest] (сквозные минуты)"""
+        self._ensure_loaded()
+        target = to_minute(date, slot)
+        base = target - target % step
+        found = []
+        with self._lock:
+            # Кандидаты по возрастанию расстояния: base, base + step, base - step, ...
+            for k in range(2 * MINUTES_PER_DAY // step + 1):
+                start = base + (k + 1) // 2 * step * (1 if k % 2 else -1)
+                if start == target or not earliest <= start <= latest:
+                    continue
+                if self._fits(start, duration, gender):
+                    found.append(from_minute(start))
+                    if len(found) == count:
+                        break
+        return sorted(found)
+    
+    def _ended(self, minute):
+        # Закончиться могли только начавшиеся брони - они в начале каждого списка
+        for intervals in self._intervals.values():
+            for start, end, booking_id, _ in intervals:
+                if start >= minute:
+                    break
+                if end <= minute:
+                    yield booking_id
+    
+    def has_ended(self, minute):
+        self._ensure_loaded()
+        with self._lock:
+            return next(self._ended(minute), None) is not None
+    
+    def remove_ended(self, minute):
+        with self._lock:
+            for booking_id in list(self._ended(minute)):
+                self.remove(booking_id)
+    
+    def invalidate(self):
+        with self._lock:
+            self._intervals.clear()
+            self._by_id.clear()
+            self._free_maps.clear()
+            self._longest = 0
+            self._loaded = False
+            self.version += 1
+
+class Facility:
+    """Душевая: свои кабинки, свои брони и свой индекс занятости"""
+    
+    def __init__(self, facility_id, name, cabins):
+        self.id = facility_id
+        self.name = name
+        self.cabins = tuple(range(1, cabins + 1))
+        self.all_mask = (1 << cabins) - 1
+        self.occupancy = OccupancyIndex(facility_id, self.all_mask)
+    
+    def count_free(self, mask):
+        return bin(self.all_mask & ~mask).count('1')
+    
+    def pick_free_cabins(self, mask, count):
+        """Номера первых count свободных кабинок: по одному младшему нулевому биту маски"""
+        free = self.all_mask & ~mask
+        cabins = []
+        while free and len(cabins) < count:
+            lowest = free & -free
+            cabins.append(lowest.bit_length())
+            free ^= lowest
+        return cabins
+
+def load_facilities():
+    """Душевые из FACILITIES - JSON вида [{"id": "dorm2", "name": "Общежитие 2", "cabins": 4}, ...].
+    Без него - одна душевая на CABIN_COUNT кабинок"""
+    raw = os.environ.get('FACILITIES')
+    items = json.loads(raw) if raw else [{'id': 'main', 'name': "Душевая", 'cabins': CABIN_COUNT}]
+    facilities = {}
+    for item in items:
+        facility_id = str(item['id'])
+        facilities[facility_id] = Facility(facility_id, item['name'], int(item.get('cabins', CABIN_COUNT)))
+    return facilities
+
+FACILITIES = load_facilities()
+# Первая душевая в списке; к ней относятся брони, созданные до появления душевых
+DEFAULT_FACILITY = next(iter(FACILITIES.values()))
+
+def invalidate_occupancy():
+    for facility in FACILITIES.values():
+        facility.occupancy.invalidate()
+
+@instrumented_db
+def book_cabins(user_id, facility_id, date, slot, duration, cabins_count):
+    """Проверяет доступность и бронирует кабинки душевой в одной транзакции.
+    Возвращает список забронированных кабинок или пустой список, если мест уже нет"""
+    facility = FACILITIES[facility_id]
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO bookings (user_id, time, cabin_number) VALUES (?, ?, ?)',
-        (user_id, time, cabin_number)
-    )
-    conn.commit()
-    conn.close()
+    # BEGIN IMMEDIATE сразу берёт блокировку на запись, поэтому между проверкой
+    # и вставкой никто другой не успеет занять те же кабинки
+    begin_immediate(cursor)
+    try:
+        cursor.execute('SELECT gender FROM users WHERE user_id = ?', (user_id,))
+        user = cursor.fetchone()
+        # Брони короче суток, поэтому пересечься с [start, end) могут только начавшиеся
+        # за сутки до start: это диапазон по индексу (facility, date, slot), остальное фильтруем здесь
+        start = to_minute(date, slot)
+        cursor.execute('''
+            SELECT b.date, b.slot, b.duration, b.cabin_number, u.gender
+            FROM bookings b
+            JOIN users u ON b.user_id = u.user_id
+            WHERE b.facility = ? AND (b.date, b.slot) > (?, ?) AND (b.date, b.slot) < (?, ?)
+        ''', (facility_id, *from_minute(start - MINUTES_PER_DAY), *from_minute(start + duration)))
+        mask, gender = 0, None
+        for b_date, b_slot, b_duration, cabin, b_gender in cursor.fetchall():
+            if to_minute(b_date, b_slot) + b_duration > start:
+                mask |= cabin_bit(cabin)
+                gender = merge_gender(gender, b_gender)
+        
+        if not user or gender not in (None, user[0]):
+            conn.rollback()
+            return []
+        
+        free_cabins = facility.pick_free_cabins(mask, cabins_count)
+        if len(free_cabins) < cabins_count:
+            conn.rollback()
+            return []
+        
+        booked = []
+        for cabin in free_cabins:
+            cursor.execute(
+                'INSERT INTO bookings (user_id, facility, date, slot, duration, cabin_number) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (user_id, facility_id, date, slot, duration, cabin)
+            )
+            booked.append((cursor.lastrowid, cabin))
+        conn.commit()
+    except db.integrity_errors:
+        conn.rollback()
+        return []
+    except Exception:
+        conn.rollback()
+        raise
+    
+    for booking_id, cabin in booked:
+        facility.occupancy.add(booking_id, date, slot, duration, cabin, user[0])
+    return [cabin for _, cabin in booked]
 
+@instrumented_db
 def delete_booking(booking_id):
     conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute('SELECT facility FROM bookings WHERE id = ?', (booking_id,))
+    row = cursor.fetchone()
     cursor.execute('DELETE FROM bookings WHERE id = ?', (booking_id,))
     conn.commit()
-    conn.close()
+    # Индекс и расписание меняются только у душевой этой брони
+    if row and row[0] in FACILITIES:
+        FACILITIES[row[0]].occupancy.remove(booking_id)
+
+def utilisation_buckets(date, slot, duration):
+    """Раскладывает бронь по часам: (день недели, час, минут брони в этом часе)"""
+    start = to_minute(date, slot)
+    end = start + duration
+    while start < end:
+        chunk_end = min(end, start - start % 60 + 60)
+        day, offset = divmod(start, MINUTES_PER_DAY)
+        yield datetime.fromordinal(day).weekday(), offset // 60, chunk_end - start
+        start = chunk_end
 
+def archive_bookings(cursor, rows):
+    """Добавляет брони в архив и в сводку utilisation; вызывается внутри транзакции очистки.
+    rows - (id, user_id, facility, date, slot, duration, cabin_number, gender, created_at)"""
+    cursor.executemany('''
+        INSERT INTO bookings_archive
+            (id, user_id, facility, date, slot, duration, cabin_number, gender, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    
+    # Сначала суммируем в памяти: одна строка сводки на (душевая, день недели, час, пол)
+    totals = {}
+    for _, _, facility_id, date, slot, duration, _, gender, _ in rows:
+        for i, (weekday, hour, minutes) in enumerate(utilisation_buckets(date, slot, duration)):
+            key = (facility_id, weekday, hour, gender)
+            count, total = totals.get(key, (0, 0))
+            totals[key] = (count + (i == 0), total + minutes)
+    cursor.executemany('''
+        INSERT INTO utilisation (facility, weekday, hour, gender, bookings, minutes)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (facility, weekday, hour, gender) DO UPDATE
+        SET bookings = bookings + excluded.bookings, minutes = minutes + excluded.minutes
+    ''', [(*key, count, total) for key, (count, total) in totals.items()])
+
+@instrumented_db
 def cleanup_old_bookings():
-    """Удаляет брони, время которых уже прошло"""
+    """Переносит в архив брони, которые уже закончились"""
+    today, now_slot = current_slot()
+    now_minute = to_minute(today, now_slot)
+    
+    # Чистим только душевые, где по индексу занятости есть что удалять;
+    # если таких нет, не берём блокировку на запись
+    expired = [f for f in FACILITIES.values() if f.occupancy.has_ended(now_minute)]
+    if not expired:
+        return 0
+    
     conn = get_db_connection()
     cursor = conn.cursor()
-    current_time = datetime.now().strftime("%H:%M")
     
-    # Удаляем брони, время которых меньше текущего времени
-    cursor.execute('DELETE FROM bookings WHERE time < ?', (current_time,))
-    deleted_count = cursor.rowcount
+    begin_immediate(cursor)
+    try:
+        # Начавшиеся брони - диапазон по индексу (facility, date, slot), из них берём закончившиеся
+        ended = []
+        for facility in expired:
+            cursor.execute('''
+                SELECT b.id, b.user_id, b.facility, b.date, b.slot, b.duration, b.cabin_number,
+                       COALESCE(u.gender, 'unknown'), b.created_at
+                FROM bookings b
+                LEFT JOIN users u ON b.user_id = u.user_id
+                WHERE b.facility = ? AND (b.date, b.slot) < (?, ?)
+                  AND b.slot + b.duration <= (julianday(?) - julianday(b.date)) * 1440 + ?
+            ''', (facility.id, today, now_slot, today, now_slot))
+            ended.extend(cursor.fetchall())
+        
+        archive_bookings(cursor, ended)
+        cursor.executemany('DELETE FROM bookings WHERE id = ?', [(row[0],) for row in ended])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     
-    conn.commit()
-    conn.close()
+    deleted_count = len(ended)
+    for facility in expired:
+        facility.occupancy.remove_ended(now_minute)
     
     if deleted_count > 0:
-        logging.info(f"Удалено {deleted_count} прошедших бронирований")
+        logging.info(f"В архив перенесено {deleted_count} прошедших бронирований")
     
     return deleted_count
 
-def check_availability(time, user_id):
-    # Сначала очищаем старые брони
-    cleanup_old_bookings()
-    
+def sync_external_changes():
+    """Сбрасывает занятость и кэш профилей, если базу изменил другой процесс или инстанс"""
+    if db.refresh():
+        invalidate_occupancy()
+        user_cache.clear()
+
+@instrumented_db
+def check_availability(facility_id, date, slot, duration, user_id):
     user = get_user(user_id)
     if not user:
         return 0
     
-    bookings = get_all_bookings()
-    time_bookings = [b for b in bookings if b[0] == time]
+    # Число свободных кабинок; 0, если интервал уже делят с другим полом
+    facility = FACILITIES[facility_id]
+    mask, gender = facility.occupancy.busy(date, slot, duration)
+    if gender not in (None, user['gender']):
+        return 0
+    return facility.count_free(mask)
+
+@instrumented_db
+def suggest_slots(facility_id, date, slot, duration, user_id):
+    """Ближайшие к занятому времени свободные (дата, слот) для пола пользователя"""
+    user = get_user(user_id)
+    if not user:
+        return []
+    
+    now = datetime.now()
+    last_day = (now + timedelta(days=BOOKING_DAYS_AHEAD)).date().isoformat()
+    return FACILITIES[facility_id].occupancy.suggest(
+        date, slot, duration, user['gender'],
+        earliest=to_minute(*current_slot(now)), latest=to_minute(last_day, MINUTES_PER_DAY - 1),
+        count=SUGGESTION_COUNT, step=SUGGESTION_STEP,
+    )
+
+# Telegram принимает сообщения до 4096 символов; страница расписания короче,
+# чтобы к ней поместилось подтверждение брони или подсказка
+SCHEDULE_PAGE_LIMIT = 3500
+
+def tg_len(text):
+    """Длина текста так, как её считает Telegram: в единицах UTF-16 (эмодзи - две)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def render_schedule(bookings, title, time_icon, today):
+    """Собирает страницы расписания из строк get_all_bookings(), отсортированных по дате и времени.
+    Брони одного времени не разрываются между страницами, заголовок повторяется на каждой"""
+    header = f"{title}\n\n"
+    groups = []
+    current_key = None
+    for date, slot, duration, cabin, gender, name in bookings:
+        if (date, slot, duration) != current_key:
+            groups.append([f"{time_icon} {format_span(date, slot, duration, today)}:\n"])
+            current_key = (date, slot, duration)
+        gender_icon = "👨" if gender == "male" else "👩"
+        groups[-1].append(f"   🚿 Ключ {cabin} {gender_icon} {name}\n")
+    
+    pages = []
+    page = []
+    size = tg_len(header)
+    for group in map("".join, groups):
+        # +1 - пустая строка между группами
+        group_size = tg_len(group) + 1
+        if page and size + group_size > SCHEDULE_PAGE_LIMIT:
+            pages.append(header + "\n".join(page) + "\n")
+            page, size = [], tg_len(header)
+        page.append(group)
+        size += group_size
+    pages.append(header + "\n".join(page) + "\n")
+    return pages
+
+# (душевая, title, time_icon, сегодняшняя дата) -> (версия броней, страницы или None, если броней нет)
+_schedule_cache = {}
+
+async def get_schedule_pages(facility, title, time_icon):
+    """Страницы расписания душевой из кэша; заново собираются только после изменения её броней
+    (или в полночь, когда меняются подписи 'сегодня'/'завтра')"""
+    version = facility.occupancy.version
+    today = datetime.now().date().isoformat()
+    key = (facility.id, title, time_icon, today)
+    cached = _schedule_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    
+    if len(FACILITIES) > 1:
+        title = f"{title}\n🏢 {facility.name}"
+    bookings = await db_read(get_all_bookings, facility.id)
+    pages = render_schedule(bookings, title, time_icon, today) if bookings else None
+    # Записи за прошлые дни больше не понадобятся
+    for stale in [k for k in _schedule_cache if k[3] != today]:
+        del _schedule_cache[stale]
+    _schedule_cache[key] = (version, pages)
+    return pages
+
+# Клавиатуры не меняются, поэтому собираются один раз при импорте.
+# Кнопка выбора душевой есть, только если душевых больше одной
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("🚿 Забронировать душ"), KeyboardButton("📋 Мои брони")],
+    [KeyboardButton("📊 Все бронирования"), KeyboardButton("❌ Отменить бронь")]
+] + ([[KeyboardButton("🏢 Сменить душевую")]] if len(FACILITIES) > 1 else []), resize_keyboard=True)
+
+FACILITY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"🏢 {facility.name}", callback_data=f"facility_{facility.id}")]
+    for facility in FACILITIES.values()
+])
+
+GENDER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👨 Муж.", callback_data="gender_male")],
+    [InlineKeyboardButton("👩 Жен.", callback_data="gender_female")]
+])
+
+MY_BOOKINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Отменить бронь", callback_data="cancel_my_booking")],
+    [InlineKeyboardButton("🔄 Обновить список", callback_data="refresh_my_bookings")]
+])
+
+ALL_BOOKINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Обновить", callback_data="refresh_all_bookings")],
+    [InlineKeyboardButton("🚿 Забронировать", callback_data="book_from_list")]
+])
+
+def schedule_keyboard(page, count):
+    """Клавиатура под страницей page из count; у многостраничного расписания
+    листание и обновление - это page_<номер страницы>"""
+    if count == 1:
+        return ALL_BOOKINGS_KEYBOARD
+    
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f"page_{page - 1}"))
+    navigation.append(InlineKeyboardButton(f"📄 {page + 1}/{count}", callback_data=f"page_{page}"))
+    if page < count - 1:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f"page_{page + 1}"))
+    return InlineKeyboardMarkup([
+        navigation,
+        [InlineKeyboardButton("🔄 Обновить", callback_data=f"page_{page}")],
+        [InlineKeyboardButton("🚿 Забронировать", callback_data="book_from_list")]
+    ])
+
+async def schedule_view(facility, page=0):
+    """(текст, клавиатура) страницы расписания душевой"""
+    pages = await get_schedule_pages(facility, "📊 Все брони:", "⏰")
+    if pages is None:
+        return "📊 На данный момент нет брони.", ALL_BOOKINGS_KEYBOARD
+    page = min(page, len(pages) - 1)
+    return pages[page], schedule_keyboard(page, len(pages))
+
+async def my_bookings_view(user_id):
+    """(текст, клавиатура) списка броней пользователя"""
+    bookings = await db_read(get_user_bookings, user_id)
+    
+    if not bookings:
+        return "📭 У вас нет активных броней.", None
+    
+    bookings_text = "📋 Ваши брони:\n\n"
     
-    occupied_cabins = len(time_bookings)
+    for booking in bookings:
+        booking_id, facility_id, date, slot, duration, cabin = booking
+        bookings_text += f"⏰ {format_span(date, slot, duration)} - 🚿 Ключ {cabin}"
+        if len(FACILITIES) > 1 and facility_id in FACILITIES:
+            bookings_text += f" ({FACILITIES[facility_id].name})"
+        bookings_text += "\n"
     
-    if occupied_cabins == 0:
-        return 2
-    elif occupied_cabins == 1:
-        occupied_gender = time_bookings[0][2]
-        if occupied_gender == user['gender']:
-            return 1
-        else:
-            return 0
-    else:
-        return 0
+    return bookings_text, MY_BOOKINGS_KEYBOARD
+
+async def cancel_menu_view(user_id):
+    """(текст, клавиатура) меню отмены - только свои брони"""
+    bookings = await db_read(get_user_bookings, user_id)
+    
+    if not bookings:
+        return "У вас нет активных бронирований для отмены.", None
+    
+    keyboard = []
+    
+    for booking in bookings:
+        booking_id, _, date, slot, duration, cabin = booking
+        button_text = f"⏰ {format_span(date, slot, duration)} (ключ {cabin})"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"cancel_{booking_id}")])
+    
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
+    return "Выберите бронирование для отмены:", InlineKeyboardMarkup(keyboard)
 
-def get_main_menu_keyboard():
-    return ReplyKeyboardMarkup([
-        [KeyboardButton("🚿 Забронировать душ"), KeyboardButton("📋 Мои брони")],
-        [KeyboardButton("📊 Все бронирования"), KeyboardButton("❌ Отменить бронь")]
-    ], resize_keyboard=True)
+async def edit_if_changed(query, text, reply_markup=None):
+    """Редактирует сообщение с кнопкой на месте. Если текст и клавиатура не изменились,
+    к Bot API не обращается (Telegram всё равно ответил бы 'message is not modified')"""
+    message = query.message
+    # Telegram обрезает пробелы и переводы строк по краям текста
+    if message is not None and (message.text or '').strip() == text.strip() and message.reply_markup == reply_markup:
+        return False
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            raise
+        return False
+    return True
 
+@instrumented_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if not get_user(user_id):
-        keyboard = [
-            [InlineKeyboardButton("👨 Муж.", callback_data="gender_male")],
-            [InlineKeyboardButton("👩 Жен.", callback_data="gender_female")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+    if not await db_read(get_user, user_id):
         await update.message.reply_text(
             "🚿 Добро пожаловать в систему бронирования душа!\n\n"
             "Для начала выберите ваш пол:",
-            reply_markup=reply_markup
+            reply_markup=GENDER_KEYBOARD
         )
     else:
         await update.message.reply_text(
             "🚿 Добро пожаловать обратно!\n"
             "Используйте меню ниже для управления бронированиями:",
-            reply_markup=get_main_menu_keyboard()
+            reply_markup=MAIN_MENU_KEYBOARD
         )
 
+@instrumented_handler
 async def gender_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -192,23 +1298,59 @@ async def gender_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     gender = query.data.split('_')[1]
     name = f"{query.from_user.first_name} {query.from_user.last_name or ''}".strip()
     
-    save_user(user_id, gender, name)
+    await db_write(save_user, user_id, gender, name)
+    
+    gender_text = f"✅ Отлично! Ваш пол: {'👨 Муж.' if gender == 'male' else '👩 Жен.'}\n\n"
+    if len(FACILITIES) > 1 and (await db_read(get_user, user_id))['facility'] not in FACILITIES:
+        await query.edit_message_text(f"{gender_text}🏢 Теперь выберите душевую:", reply_markup=FACILITY_KEYBOARD)
+        return
     
     await query.edit_message_text(
-        f"✅ Отлично! Ваш пол: {'👨 Муж.' if gender == 'male' else '👩 Жен.'}\n\n"
+        f"{gender_text}"
         "Теперь вы можете забронить душ. Используйте меню ниже:"
     )
     await query.message.reply_text(
         "Выберите действие:",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KEYBOARD
+    )
+
+@instrumented_handler
+async def facility_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    facility = FACILITIES.get(query.data.split('_', 1)[1])
+    if facility is None:
+        await query.edit_message_text("❌ Такой душевой больше нет. Выберите другую:", reply_markup=FACILITY_KEYBOARD)
+        return
+    
+    await db_write(set_user_facility, query.from_user.id, facility.id)
+    
+    await query.edit_message_text(f"✅ Ваша душевая: 🏢 {facility.name}")
+    await query.message.reply_text(
+        "Выберите действие:",
+        reply_markup=MAIN_MENU_KEYBOARD
     )
 
+async def get_user_facility(user_id, message):
+    """Душевая пользователя. Если она не выбрана (или убрана из настроек),
+    предлагает выбрать и возвращает None"""
+    if len(FACILITIES) == 1:
+        return DEFAULT_FACILITY
+    
+    user = await db_read(get_user, user_id)
+    facility = FACILITIES.get(user['facility']) if user else None
+    if facility is None:
+        await message.reply_text("🏢 Выберите душевую:", reply_markup=FACILITY_KEYBOARD)
+    return facility
+
+@instrumented_handler
 async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Если пользователь в процессе бронирования, обрабатываем как ввод времени
     if context.user_data.get('booking_step') == 'waiting_time':
         # Проверяем, является ли сообщение командой меню
         text = update.message.text
-        if text in ["🚿 Забронировать душ", "📋 Мои брони", "📊 Все бронирования", "❌ Отменить бронь"]:
+        if text in MENU_ACTIONS:
             # Если это команда меню, сбрасываем состояние и обрабатываем команду
             context.user_data.pop('booking_step', None)
             await handle_menu_command(update, context)
@@ -221,262 +1363,244 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команд из меню"""
-    text = update.message.text
-    
-    if text == "🚿 Забронировать душ":
-        await start_booking(update, context)
-    elif text == "📋 Мои брони":
-        await show_my_bookings(update, context)
-    elif text == "📊 Все бронирования":
-        await show_all_bookings(update, context)
-    elif text == "❌ Отменить бронь":
-        await cancel_booking_menu(update, context)
+    action = MENU_ACTIONS.get(update.message.text)
+    if action is not None:
+        await action(update, context)
 
+@instrumented_handler
 async def start_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Очищаем старые брони перед показом
-    cleanup_old_bookings()
-    
-    bookings = get_all_bookings()
+    await begin_booking(update.effective_user.id, update.message, context)
+
+async def begin_booking(user_id, message, context):
+    """Показывает занятость душевой и просит ввести время; ответ приходит в чат message"""
+    facility = await get_user_facility(user_id, message)
+    if facility is None:
+        return
     
-    if bookings:
-        time_groups = {}
-        for time, cabin, gender, name in bookings:
-            if time not in time_groups:
-                time_groups[time] = []
-            time_groups[time].append((cabin, gender, name))
-        
-        busy_text = "📊 Текущие бронирования:\n\n"
-        
-        for time, cabins in sorted(time_groups.items()):
-            busy_text += f"🕐 {time}:\n"
-            for cabin, gender, name in cabins:
-                gender_icon = "👨" if gender == "male" else "👩"
-                busy_text += f"   🚿 Ключ {cabin} {gender_icon} {name}\n"
-            busy_text += "\n"
-    else:
+    pages = await get_schedule_pages(facility, "📊 Текущие бронирования:", "🕐")
+    if pages is None:
         busy_text = "📊 На данный момент нет бронирований."
+    elif len(pages) == 1:
+        busy_text = pages[0]
+    else:
+        busy_text = f"{pages[0]}📄 Страница 1 из {len(pages)}, полностью - в «📊 Все бронирования»"
     
     context.user_data['booking_step'] = 'waiting_time'
     
-    await update.message.reply_text(
+    await message.reply_text(
         f"{busy_text}\n\n"
-        "⏰ Введите время для бронирования в формате ЧЧ:MM (например, 14:30):\n\n"
+        "⏰ Введите время для бронирования в формате ЧЧ:MM (например, 14:30) "
+        "или ДД.ММ ЧЧ:ММ для другого дня (например, 25.10 09:00):\n\n"
         "💡 Вы можете вернуться в меню, нажав любую кнопку ниже",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KEYBOARD
     )
 
+def booking_window_error(date, slot, now):
+    """Текст ошибки, если время уже прошло или слишком далеко; иначе None"""
+    when_text = format_span(date, slot, BOOKING_DURATION)
+    if (date, slot) < current_slot(now):
+        return f"❌ Время {when_text} уже прошло. Пожалуйста, выберите другое время:"
+    if date > (now + timedelta(days=BOOKING_DAYS_AHEAD)).date().isoformat():
+        return (
+            f"❌ Бронировать можно не дальше чем на {BOOKING_DAYS_AHEAD} дн. вперёд. "
+            "Пожалуйста, выберите другое время:"
+        )
+    return None
+
+@instrumented_handler
 async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    time_text = update.message.text.strip()
+    now = datetime.now()
+    when = parse_when(update.message.text.strip(), now)
     
-    try:
-        datetime.strptime(time_text, "%H:%M")
-    except ValueError:
+    if when is None:
         await update.message.reply_text(
-            "❌ Неверный формат времени. Пожалуйста, введите время в формате ЧЧ:MM (например, 14:30):"
+            "❌ Неверный формат времени. Пожалуйста, введите время в формате ЧЧ:MM (например, 14:30) "
+            "или ДД.ММ ЧЧ:ММ (например, 25.10 09:00):"
         )
         return
     
-    available_cabins = check_availability(time_text, user_id)
+    error = booking_window_error(*when, now)
+    if error:
+        await update.message.reply_text(error)
+        return
+    
+    facility = await get_user_facility(user_id, update.message)
+    if facility is None:
+        return
+    
+    await offer_cabins(update.message.reply_text, context, user_id, facility, *when)
+
+@instrumented_handler
+async def pick_suggested_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор одного из предложенных свободных времён: pick_<дата>_<слот>"""
+    query = update.callback_query
+    await query.answer()
+    
+    _, date, slot = query.data.split('_')
+    slot = int(slot)
+    
+    error = booking_window_error(date, slot, datetime.now())
+    if error:
+        await query.edit_message_text(error)
+        return
+    
+    facility = await get_user_facility(query.from_user.id, query.message)
+    if facility is None:
+        return
+    
+    await offer_cabins(query.edit_message_text, context, query.from_user.id, facility, date, slot)
+
+async def offer_cabins(reply, context, user_id, facility, date, slot):
+    """Предлагает выбрать число ключей на (date, slot), а если мест нет - ближайшие свободные времена.
+    reply - reply_text сообщения или edit_message_text callback-запроса"""
+    when_text = format_span(date, slot, BOOKING_DURATION)
+    available_cabins = await db_read(check_availability, facility.id, date, slot, BOOKING_DURATION, user_id)
     
     if available_cabins == 0:
-        current_bookings = [b for b in get_all_bookings() if b[0] == time_text]
-        reason = "оба ключа заняты" if len(current_bookings) == 2 else "разные полы не могут делить время"
+        mask, _ = await db_read(facility.occupancy.busy, date, slot, BOOKING_DURATION)
+        reason = "все ключи заняты" if mask == facility.all_mask else "разные полы не могут делить время"
+        suggestions = await db_read(suggest_slots, facility.id, date, slot, BOOKING_DURATION, user_id)
         
-        await update.message.reply_text(
-            f"❌ На время {time_text} нет свободных кабинок.\n"
+        if not suggestions:
+            await reply(
+                f"❌ На время {when_text} нет свободных кабинок.\n"
+                f"ℹ️ Причина: {reason}\n"
+                "Пожалуйста, выберите другое время:"
+            )
+            return
+        
+        keyboard = [
+            [InlineKeyboardButton(f"⏰ {format_span(s_date, s_slot, BOOKING_DURATION)}",
+                                  callback_data=f"pick_{s_date}_{s_slot}")]
+            for s_date, s_slot in suggestions
+        ]
+        keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data="cancel_booking_process")])
+        await reply(
+            f"❌ На время {when_text} нет свободных кабинок.\n"
             f"ℹ️ Причина: {reason}\n"
-            "Пожалуйста, выберите другое время:"
+            "Ближайшее свободное время - выберите или введите другое:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
         return
     
-    context.user_data['selected_time'] = time_text
+    context.user_data['selected_facility'] = facility.id
+    context.user_data['selected_date'] = date
+    context.user_data['selected_slot'] = slot
     context.user_data['available_cabins'] = available_cabins
-    context.user_data['booking_step'] = None
-    
-    keyboard = []
-    
-    if available_cabins >= 1:
-        keyboard.append([InlineKeyboardButton("🚿 1 ключ", callback_data="confirm_1")])
-    if available_cabins == 2:
-        keyboard.append([InlineKeyboardButton("🚿🚿 2 ключа", callback_data="confirm_2")])
+    context.user_data.pop('booking_step', None)
     
+    keyboard = [
+        [InlineKeyboardButton(f"{'🚿' * count} {count} {keys_word(count)}", callback_data=f"confirm_{count}")]
+        for count in range(1, available_cabins + 1)
+    ]
     keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data="cancel_booking_process")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
-        f"🕐 Время: {time_text}\n"
+    await reply(
+        f"🕐 Время: {when_text}\n"
         f"📊 Доступно ключей: {available_cabins}\n\n"
         "Выберите количество ключей:",
         reply_markup=reply_markup
     )
 
+def clear_selection(context):
+    """Сбрасывает выбранные в процессе бронирования душевую, дату, время и число ключей"""
+    context.user_data.pop('selected_facility', None)
+    context.user_data.pop('selected_date', None)
+    context.user_data.pop('selected_slot', None)
+    context.user_data.pop('available_cabins', None)
+
+@instrumented_handler
 async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     cabins_count = int(query.data.split('_')[1])
-    selected_time = context.user_data.get('selected_time')
+    selected_facility = context.user_data.get('selected_facility')
+    selected_date = context.user_data.get('selected_date')
+    selected_slot = context.user_data.get('selected_slot')
     user_id = query.from_user.id
     
-    if not selected_time:
+    if selected_facility not in FACILITIES or selected_date is None or selected_slot is None:
         await query.edit_message_text("❌ Ошибка: время не выбрано. Начните бронирование заново.")
         return
     
-    available_cabins = check_availability(selected_time, user_id)
+    selected_time = format_span(selected_date, selected_slot, BOOKING_DURATION)
+    available_cabins = await db_read(
+        check_availability, selected_facility, selected_date, selected_slot, BOOKING_DURATION, user_id
+    )
     if available_cabins < cabins_count:
         await query.edit_message_text(
             f"❌ К сожалению, сейчас доступно только {available_cabins} ключ(ей) на время {selected_time}. "
             "Пожалуйста, начните бронирование заново."
         )
-        context.user_data.pop('selected_time', None)
-        context.user_data.pop('available_cabins', None)
+        clear_selection(context)
         return
     
-    available_cabins_list = [1, 2]
-    existing_bookings = get_all_bookings()
-    existing_cabins = [b[1] for b in existing_bookings if b[0] == selected_time]
-    free_cabins = [c for c in available_cabins_list if c not in existing_cabins]
+    booked_cabins = await db_write(
+        book_cabins, user_id, selected_facility, selected_date, selected_slot, BOOKING_DURATION, cabins_count
+    )
     
-    booked_cabins = []
-    for i in range(min(cabins_count, len(free_cabins))):
-        create_booking(user_id, selected_time, free_cabins[i])
-        booked_cabins.append(free_cabins[i])
+    clear_selection(context)
     
-    context.user_data.pop('selected_time', None)
-    context.user_data.pop('available_cabins', None)
+    if not booked_cabins:
+        # Кто-то успел занять кабинки между проверкой и бронированием
+        await query.edit_message_text(
+            f"❌ К сожалению, ключи на время {selected_time} только что заняли. "
+            "Пожалуйста, начните бронирование заново."
+        )
+        return
     
     if cabins_count == 1:
         cabins_text = f"ключ {booked_cabins[0]}"
     else:
-        cabins_text = f"ключи {booked_cabins[0]} и {booked_cabins[1]}"
+        cabins_text = f"ключи {', '.join(map(str, booked_cabins[:-1]))} и {booked_cabins[-1]}"
     
-    # Показываем подтверждение брони
+    # Подтверждение и полный список броней - одним редактированием того же сообщения
+    schedule_text, reply_markup = await schedule_view(FACILITIES[selected_facility])
     await query.edit_message_text(
         f"✅ Бронирование подтверждено!\n\n"
         f"🕐 Время: {selected_time}\n"
         f"🚿 Забронировано: {cabins_text}\n\n"
+        f"{schedule_text}",
+        reply_markup=reply_markup
     )
-    
-    # ПОСЛЕ КАЖДОЙ БРОНИ ПОКАЗЫВАЕМ ПОЛНЫЙ СПИСОК БРОНЕЙ
-    await show_all_bookings_after_booking(query, context)
-
-async def show_all_bookings_after_booking(query, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает полный список броней после добавления новой брони"""
-    # Очищаем старые брони
-    cleanup_old_bookings()
-    
-    bookings = get_all_bookings()
-    
-    if not bookings:
-        await context.bot.send_message(chat_id=query.message.chat_id, 
-                                     text="📊 На данный момент нет брони.")
-        return
-    
-    time_groups = {}
-    for time, cabin, gender, name in bookings:
-        if time not in time_groups:
-            time_groups[time] = []
-        time_groups[time].append((cabin, gender, name))
-    
-    bookings_text = "📊 Все брони:\n\n"
-    
-    for time, cabins in sorted(time_groups.items()):
-        bookings_text += f"⏰ {time}:\n"
-        for cabin, gender, name in cabins:
-            gender_icon = "👨" if gender == "male" else "👩"
-            bookings_text += f"   🚿 Ключ {cabin} {gender_icon} {name}\n"
-        bookings_text += "\n"
-    
-    await context.bot.send_message(chat_id=query.message.chat_id, 
-                                 text=bookings_text,
-                                 reply_markup=get_main_menu_keyboard())
 
+@instrumented_handler
 async def show_my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Очищаем старые брони перед показом
-    cleanup_old_bookings()
-    
-    user_id = update.effective_user.id
-    bookings = get_user_bookings(user_id)
-    
-    if not bookings:
-        await update.message.reply_text("📭 У вас нет активных броней.")
-        return
-    
-    bookings_text = "📋 Ваши брони:\n\n"
-    
-    for booking in bookings:
-        booking_id, time, cabin = booking
-        bookings_text += f"⏰ {time} - 🚿 Ключ {cabin}\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("❌ Отменить бронь", callback_data="cancel_my_booking")],
-        [InlineKeyboardButton("🔄 Обновить список", callback_data="refresh_my_bookings")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(bookings_text, reply_markup=reply_markup)
+    text, reply_markup = await my_bookings_view(update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
+@instrumented_handler
 async def show_all_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Очищаем старые брони перед показом
-    cleanup_old_bookings()
-    
-    bookings = get_all_bookings()
-    
-    if not bookings:
-        await update.message.reply_text("📊 На данный момент нет брони.")
+    facility = await get_user_facility(update.effective_user.id, update.message)
+    if facility is None:
         return
     
-    time_groups = {}
-    for time, cabin, gender, name in bookings:
-        if time not in time_groups:
-            time_groups[time] = []
-        time_groups[time].append((cabin, gender, name))
-    
-    bookings_text = "📊 Все брони:\n\n"
-    
-    for time, cabins in sorted(time_groups.items()):
-        bookings_text += f"⏰ {time}:\n"
-        for cabin, gender, name in cabins:
-            gender_icon = "👨" if gender == "male" else "👩"
-            bookings_text += f"   🚿 Ключ {cabin} {gender_icon} {name}\n"
-        bookings_text += "\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("🔄 Обновить", callback_data="refresh_all_bookings")],
-        [InlineKeyboardButton("🚿 Забронировать", callback_data="book_from_list")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(bookings_text, reply_markup=reply_markup)
+    text, reply_markup = await schedule_view(facility)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
+@instrumented_handler
 async def cancel_booking_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Меню отмены бронирования - показываем только свои брони"""
-    # Очищаем старые брони перед показом
-    cleanup_old_bookings()
-    
-    user_id = update.effective_user.id
-    bookings = get_user_bookings(user_id)
-    
-    if not bookings:
-        await update.message.reply_text("У вас нет активных бронирований для отмены.")
-        return
-    
-    keyboard = []
-    
-    for booking in bookings:
-        booking_id, time, cabin = booking
-        button_text = f"⏰ {time} (ключ {cabin})"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"cancel_{booking_id}")])
-    
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "Выберите бронирование для отмены:",
-        reply_markup=reply_markup
-    )
+    text, reply_markup = await cancel_menu_view(update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+@instrumented_handler
+async def choose_facility(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("🏢 Выберите душевую:", reply_markup=FACILITY_KEYBOARD)
 
+# Текст кнопки главного меню -> обработчик
+MENU_ACTIONS = {
+    "🚿 Забронировать душ": start_booking,
+    "📋 Мои брони": show_my_bookings,
+    "📊 Все бронирования": show_all_bookings,
+    "❌ Отменить бронь": cancel_booking_menu,
+    "🏢 Сменить душевую": choose_facility,
+}
+
+@instrumented_handler
 async def handle_cancel_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка отмены бронирования с проверкой владельца"""
     query = update.callback_query
@@ -492,60 +1616,980 @@ async def handle_cancel_confirmation(update: Update, context: ContextTypes.DEFAU
             booking_id = int(parts[1])
             
             # ✅ Проверяем, принадлежит ли бронь этому пользователю
-            booking_owner = get_booking_owner(booking_id)
+            booking_owner = await db_read(get_booking_owner, booking_id)
             
             if booking_owner != user_id:
                 await query.edit_message_text("❌ Ошибка: вы не можете отменить чужое бронирование!")
                 return
             
-            delete_booking(booking_id)
+            await db_write(delete_booking, booking_id)
             await query.edit_message_text("✅ Бронирование успешно отменено!")
         elif query.data == "cancel_my_booking":
-            # Это кнопка "Отменить бронь" из меню
-            await cancel_booking_from_message(query.message, context)
-        
+            # Это кнопка "Отменить бронь" под списком своих броней
+            await cancel_booking_from_message(query)
+    
     elif query.data == "refresh_my_bookings":
-        await refresh_my_bookings(query.message, context)
+        await refresh_my_bookings(query)
     elif query.data == "refresh_all_bookings":
-        await refresh_all_bookings(query.message, context)
+        await refresh_all_bookings(query)
     elif query.data == "book_from_list":
-        await start_booking_from_message(query.message, context)
+        await start_booking_from_message(query, context)
     elif query.data == "cancel_booking_process":
         await query.edit_message_text("❌ Процесс бронирования отменен.")
         context.user_data.pop('booking_step', None)
-        context.user_data.pop('selected_time', None)
-        context.user_data.pop('available_cabins', None)
+        clear_selection(context)
     elif query.data == "back_to_menu":
         await query.edit_message_text("Возврат в главное меню")
 
-async def cancel_booking_from_message(message, context):
-    await cancel_booking_menu(Update(message=message), context)
+# Кнопки под сообщениями бота меняют то же сообщение, а не присылают новое.
+# Пользователь берётся из query.from_user: автор самого сообщения - бот
+async def cancel_booking_from_message(query):
+    await edit_if_changed(query, *await cancel_menu_view(query.from_user.id))
 
-async def refresh_my_bookings(message, context):
-    await show_my_bookings(Update(message=message), context)
+async def refresh_my_bookings(query):
+    await edit_if_changed(query, *await my_bookings_view(query.from_user.id))
 
-async def refresh_all_bookings(message, context):
-    await show_all_bookings(Update(message=message), context)
+async def refresh_all_bookings(query, page=0):
+    facility = await get_user_facility(query.from_user.id, query.message)
+    if facility is None:
+        return
+    await edit_if_changed(query, *await schedule_view(facility, page))
 
-async def start_booking_from_message(message, context):
-    await start_booking(Update(message=message), context)
+@instrumented_handler
+async def schedule_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание и обновление многостраничного расписания: page_<номер страницы>"""
+    query = update.callback_query
+    await query.answer()
+    await refresh_all_bookings(query, int(query.data.split('_')[1]))
 
-def main():
-    init_db()
+async def start_booking_from_message(query, context):
+    # Просьба ввести время - новым сообщением: к нему прикрепляется клавиатура главного меню
+    await begin_booking(query.from_user.id, query.message, context)
+
+# Исходящие сообщения (напоминания, рассылки) идут не напрямую, а через таблицу outbox:
+# очередь переживает перезапуск, а отправка ограничена по скорости.
+# Сообщений в секунду из очереди - ниже общего лимита Bot API (~30/с), чтобы осталось место ответам
+OUTBOX_RATE = float(os.environ.get('OUTBOX_RATE', '25'))
+# Не чаще одного сообщения из очереди в чат за столько секунд
+OUTBOX_CHAT_INTERVAL = float(os.environ.get('OUTBOX_CHAT_INTERVAL', '1'))
+OUTBOX_MAX_ATTEMPTS = 5
+# За сколько минут до начала брони напоминать (0 - не напоминать)
+REMINDER_MINUTES = int(os.environ.get('REMINDER_MINUTES', '10'))
+# Кому доступна /broadcast
+ADMIN_IDS = {int(x) for x in os.environ.get('ADMIN_IDS', '').split(',') if x.strip()}
+# Vercel Cron (расписание - crons в vercel.json) присылает его в заголовке
+# Authorization: Bearer <CRON_SECRET> (см. handler.do_GET). Ежеминутный запуск доступен
+# не на всех тарифах Vercel; иначе GET /cron с тем же заголовком может вызывать внешний планировщик
+CRON_SECRET = os.environ.get('CRON_SECRET')
+
+def reminder_text(facility_id, date, slot, duration, cabins, minutes_left):
+    where = f" ({FACILITIES[facility_id].name})" if len(FACILITIES) > 1 and facility_id in FACILITIES else ""
+    keys = f"ключи {cabins}" if ',' in cabins else f"ключ {cabins}"
+    return (
+        f"⏰ Напоминание: через {minutes_left} мин. ваш душ{where}\n"
+        f"🕐 {format_span(date, slot, duration)}, 🚿 {keys}"
+    )
+
+@instrumented_db
+def enqueue_reminders():
+    """Ставит в очередь напоминания о бронях, начинающихся в ближайшие REMINDER_MINUTES минут.
+    Брони одного пользователя на одно время дают одно напоминание"""
+    today, now_slot = current_slot()
+    now_minute = to_minute(today, now_slot)
+    window = (today, now_slot, *from_minute(now_minute + REMINDER_MINUTES))
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    query = '''
+        SELECT user_id, facility, date, slot, duration, group_concat(cabin_number, ', ')
+        FROM bookings
+        WHERE reminded = 0 AND (date, slot) >= (?, ?) AND (date, slot) <= (?, ?)
+        GROUP BY user_id, facility, date, slot, duration
+    '''
+    
+    # Чаще всего напоминать некого - тогда обходимся чтением без блокировки на запись
+    if not cursor.execute(query, window).fetchone():
+        return 0
     
-    application = Application.builder().token("8530588036:AAHXMSKnoRV8lApbLSY8WcCOmwJg3cSObEw").build()
+    begin_immediate(cursor)
+    try:
+        rows = cursor.execute(query, window).fetchall()
+        cursor.executemany('INSERT INTO outbox (chat_id, text) VALUES (?, ?)', [
+            (user_id, reminder_text(facility_id, date, slot, duration, cabins, to_minute(date, slot) - now_minute))
+            for user_id, facility_id, date, slot, duration, cabins in rows
+        ])
+        cursor.execute('''
+            UPDATE bookings SET reminded = 1
+            WHERE reminded = 0 AND (date, slot) >= (?, ?) AND (date, slot) <= (?, ?)
+        ''', window)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+@instrumented_db
+def enqueue_broadcast(text):
+    """Ставит сообщение в очередь всем пользователям одним INSERT ... SELECT"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO outbox (chat_id, text) SELECT user_id, ? FROM users', (text,))
+    conn.commit()
+    return cursor.rowcount
+
+@instrumented_db
+def get_due_outbox(limit):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, chat_id, text, attempts
+        FROM outbox
+        WHERE not_before <= ?
+        ORDER BY not_before, id
+        LIMIT ?
+    ''', (time.time(), limit))
+    return cursor.fetchall()
+
+@instrumented_db
+def finish_outbox(done, postponed):
+    """Удаляет отправленные (или безнадёжные) сообщения и откладывает остальные.
+    postponed - список (not_before, прибавка к attempts, id)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM outbox WHERE id = ?', [(row_id,) for row_id in done])
+    cursor.executemany('UPDATE outbox SET not_before = ?, attempts = attempts + ? WHERE id = ?', postponed)
+    conn.commit()
+
+class TokenBucket:
+    """Маркерная корзина: в среднем rate операций в секунду, подряд - не больше burst"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+    
+    def ready(self):
+        """Есть ли маркер; сам маркер не забирается"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._tokens >= 1
+    
+    def try_acquire(self):
+        """Берёт маркер, если он есть, не дожидаясь"""
+        if self.ready():
+            self._tokens -= 1
+            return True
+        return False
+    
+    def wait_time(self):
+        """Через сколько секунд появится маркер"""
+        return max(0.0, (1 - self._tokens) / self.rate)
+    
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.wait_time())
+    
+    def pause(self, seconds):
+        """После RetryAfter: ни одного маркера ближайшие seconds секунд"""
+        self._tokens = -seconds * self.rate
+        self._updated = time.monotonic()
+
+class Outbox:
+    """Отправка очереди outbox: общая маркерная корзина, не чаще раза в OUTBOX_CHAT_INTERVAL на чат,
+    пачки по BATCH_SIZE; RetryAfter останавливает корзину и откладывает сообщение"""
+    
+    BATCH_SIZE = 100
+    # Пустую очередь перечитываем не чаще раза в столько секунд, если её не разбудил wake()
+    IDLE_POLL = 15
+    
+    def __init__(self, rate, chat_interval):
+        self.bucket = TokenBucket(rate, burst=rate)
+        self.chat_interval = chat_interval
+        self._chat_ready = {}
+        self._idle_until = 0.0
+    
+    def wake(self):
+        """В очередь что-то добавили - проверить её при следующем запуске"""
+        self._idle_until = 0.0
+    
+    async def drain(self, bot, budget):
+        """Отправляет, что успеет за budget секунд; неотправленное остаётся в очереди.
+        Возвращает число отправленных сообщений"""
+        now = time.monotonic()
+        if now < self._idle_until:
+            return 0
+        
+        rows = await db_read(get_due_outbox, self.BATCH_SIZE)
+        if not rows:
+            self._idle_until = now + self.IDLE_POLL
+            return 0
+        
+        deadline = now + budget
+        self._chat_ready = {chat_id: t for chat_id, t in self._chat_ready.items() if t > now}
+        sends = []
+        for row in rows:
+            if time.monotonic() >= deadline:
+                break
+            chat_id = row[1]
+            if self._chat_ready.get(chat_id, 0) > time.monotonic():
+                continue
+            await self.bucket.acquire()
+            self._chat_ready[chat_id] = time.monotonic() + self.chat_interval
+            sends.append(asyncio.create_task(self._send(bot, row)))
+        
+        results = await asyncio.gather(*sends)
+        done = [row_id for row_id, retry, _ in results if retry is None]
+        postponed = [(*retry, row_id) for row_id, retry, _ in results if retry is not None]
+        if done or postponed:
+            await db_write(finish_outbox, done, postponed)
+        return sum(sent for _, _, sent in results)
+    
+    async def _send(self, bot, row):
+        """Возвращает (id, None или (not_before, прибавка к attempts), отправлено ли)"""
+        row_id, chat_id, text, attempts = row
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            self.bucket.pause(e.retry_after)
+            return row_id, (time.time() + e.retry_after, 0), False
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован или чата нет - повтор не поможет
+            logging.warning(f"Сообщение из очереди в чат {chat_id} отброшено: {e}")
+            return row_id, None, False
+        except TelegramError as e:
+            if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logging.warning(f"Сообщение из очереди в чат {chat_id} отброшено после {attempts + 1} попыток: {e}")
+                return row_id, None, False
+            return row_id, (time.time() + 5 * 2 ** attempts, 1), False
+        return row_id, None, True
+
+outbox = Outbox(OUTBOX_RATE, OUTBOX_CHAT_INTERVAL)
+
+# Пауза между запусками отправки очереди, секунд
+OUTBOX_TICK = 1.0
+
+async def drain_outbox_job(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет очередь и сам планирует следующий запуск - запуски не накладываются друг на друга"""
+    try:
+        await outbox.drain(context.bot, budget=OUTBOX_TICK)
+    finally:
+        context.job_queue.run_once(drain_outbox_job, when=OUTBOX_TICK, name='drain_outbox')
+
+async def reminders_job(context: ContextTypes.DEFAULT_TYPE):
+    if await db_write(enqueue_reminders):
+        outbox.wake()
+
+async def run_outbox_once(bot, budget):
+    """Напоминания и отправка очереди без job queue (webhook-режим, вызывается по cron)"""
+    if REMINDER_MINUTES:
+        await db_write(enqueue_reminders)
+    outbox.wake()
+    deadline = time.monotonic() + budget
+    sent = 0
+    while time.monotonic() < deadline:
+        batch = await outbox.drain(bot, budget=deadline - time.monotonic())
+        if not batch:
+            break
+        sent += batch
+    return sent
+
+@instrumented_handler
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast <текст> - рассылка всем пользователям через очередь (только для ADMIN_IDS)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("Использование: /broadcast текст сообщения")
+        return
+    
+    count = await db_write(enqueue_broadcast, parts[1])
+    outbox.wake()
+    await update.message.reply_text(f"📣 Рассылка поставлена в очередь: {count} получателей.")
+
+# Выгрузки для отчётов: запрос и названия колонок. Сводка utilisation - готовая тепловая карта
+# по часам и дням недели (0 - понедельник); архив - сырые брони
+EXPORTS = {
+    'archive': ('''
+        SELECT id, user_id, facility, date, printf('%02d:%02d', slot / 60, slot % 60),
+               duration, cabin_number, gender, created_at, archived_at
+        FROM bookings_archive
+        ORDER BY id
+    ''', ('id', 'user_id', 'facility', 'date', 'time', 'duration', 'cabin', 'gender', 'created_at', 'archived_at')),
+    'utilisation': ('''
+        SELECT facility, weekday, hour, gender, bookings, minutes
+        FROM utilisation
+        ORDER BY facility, weekday, hour, gender
+    ''', ('facility', 'weekday', 'hour', 'gender', 'bookings', 'minutes')),
+}
+EXPORT_FORMATS = ('csv', 'json')
+# Сколько строк выгрузки читать из курсора за раз
+EXPORT_BATCH_SIZE = 500
+
+def iter_rows(cursor, size):
+    """Строки курсора пачками через fetchmany: курсор libSQL, в отличие от sqlite3, не итерируется"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+@instrumented_db
+def export_data(kind, fmt, out):
+    """Пишет выгрузку kind в текстовый поток out (csv или json-массив) по одной строке
+    прямо из курсора - память не зависит от размера архива. Возвращает число строк"""
+    import csv
+    
+    query, columns = EXPORTS[kind]
+    cursor = get_db_connection().cursor()
+    cursor.execute(query)
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in iter_rows(cursor, EXPORT_BATCH_SIZE):
+            writer.writerow(row)
+            count += 1
+    else:
+        out.write('[')
+        for row in iter_rows(cursor, EXPORT_BATCH_SIZE):
+            out.write(',\n' if count else '\n')
+            out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+            count += 1
+        out.write('\n]\n')
+    return count
+
+@instrumented_handler
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [archive|utilisation] [csv|json] - выгрузка файлом (только для ADMIN_IDS)"""
+    import io
+    import tempfile
+    
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    
+    kind = context.args[0] if context.args else 'utilisation'
+    fmt = context.args[1] if len(context.args) > 1 else 'csv'
+    if kind not in EXPORTS or fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("Использование: /export [archive|utilisation] [csv|json]")
+        return
+    
+    # Выгрузка пишется во временный файл на диске, а не собирается строкой в памяти
+    with tempfile.TemporaryFile() as file:
+        text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        count = await db_read(export_data, kind, fmt, text)
+        text.detach()
+        file.seek(0)
+        await update.message.reply_document(
+            document=file, filename=f"{kind}.{fmt}", caption=f"📦 {kind}: {count} строк"
+        )
+
+# Ограничение частоты запросов пользователя перед обработчиками: маркерная корзина на все его
+# запросы и по корзине на каждый вид запроса (кнопка меню, тип callback-кнопки).
+# Запросов в секунду в среднем и подряд; RATE_LIMIT_RATE=0 и RATE_LIMIT_ACTION_RATE=0 - без ограничения
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', '1'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '5'))
+RATE_LIMIT_ACTION_RATE = float(os.environ.get('RATE_LIMIT_ACTION_RATE', '0.5'))
+RATE_LIMIT_ACTION_BURST = float(os.environ.get('RATE_LIMIT_ACTION_BURST', '3'))
+
+class RateLimiter:
+    """Корзины пользователей; давно не писавшие вытесняются (их лимит просто начнётся заново)"""
+    
+    MAX_USERS = 10000
+    
+    def __init__(self, rate, burst, action_rate, action_burst):
+        self.rate = rate
+        self.burst = burst
+        self.action_rate = action_rate
+        self.action_burst = action_burst
+        # user_id -> {'bucket', 'actions', 'last' - последний пропущенный запрос, 'notice_until'}
+        self._users = OrderedDict()
+    
+    @property
+    def enabled(self):
+        return self.rate > 0 or self.action_rate > 0
+    
+    def _state(self, user_id):
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = {
+                'bucket': TokenBucket(self.rate, self.burst) if self.rate > 0 else None,
+                'actions': {},
+                'last': None,
+                'notice_until': 0.0,
+            }
+            if len(self._users) > self.MAX_USERS:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+    
+    def check(self, user_id, action, request):
+        """'ok'; 'coalesced' - сверх лимита повторён последний пропущенный запрос, ответ на него уже есть;
+        'limited' - сверх лимита. Вторым значением - через сколько секунд можно снова"""
+        state = self._state(user_id)
+        buckets = [state['bucket']]
+        if self.action_rate > 0:
+            buckets.append(state['actions'].setdefault(action, TokenBucket(self.action_rate, self.action_burst)))
+        buckets = [bucket for bucket in buckets if bucket is not None]
+        
+        # Маркер забираем, только если он есть в каждой корзине: отказ по одной не тратит другую
+        if all(bucket.ready() for bucket in buckets):
+            for bucket in buckets:
+                bucket.try_acquire()
+            state['last'] = request
+            return 'ok', 0.0
+        wait = max(bucket.wait_time() for bucket in buckets)
+        # Повтор пропущенного запроса: ответ на него уже на экране
+        return ('coalesced' if request == state['last'] else 'limited'), wait
+    
+    def should_notify(self, user_id, wait):
+        """Предупреждать сообщением не чаще раза за период ожидания"""
+        state = self._state(user_id)
+        now = time.monotonic()
+        if now < state['notice_until']:
+            return False
+        state['notice_until'] = now + wait
+        return True
+
+rate_limiter = RateLimiter(RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_ACTION_RATE, RATE_LIMIT_ACTION_BURST)
+
+async def rate_limit(update: Update):
+    """Вызывается из update_processor до обработчиков и до любой работы с базой.
+    Сверх лимита отвечает коротко (или вовсе не отвечает на повтор того же запроса)
+    и возвращает True - тогда update не обрабатывается"""
+    user = update.effective_user
+    query = update.callback_query
+    if not rate_limiter.enabled or user is None:
+        return False
+    if query is not None:
+        # Вид callback-запроса - префикс данных: refresh, page, confirm, cancel...
+        action, request = query.data.split('_', 1)[0], ('callback', query.data)
+    elif update.message is not None and update.message.text:
+        text = update.message.text
+        action, request = (text if text in MENU_ACTIONS else 'text'), ('message', text)
+    else:
+        return False
+    
+    verdict, wait = rate_limiter.check(user.id, action, request)
+    if verdict == 'ok':
+        return False
+    
+    metrics.count('rate_limit', verdict)
+    if query is not None:
+        # На callback ответить нужно всё равно, иначе у кнопки будут "часики"; это не сообщение в чат
+        await query.answer(f"⏳ Слишком часто. Попробуйте через {int(wait) + 1} с." if verdict == 'limited' else None)
+    elif verdict == 'limited' and rate_limiter.should_notify(user.id, wait):
+        await update.message.reply_text(f"⏳ Слишком много запросов. Подождите {int(wait) + 1} с.")
+    return True
+
+async def expire_bookings_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача: удаляет прошедшие брони на границе каждого слота"""
+    await db_write(cleanup_old_bookings)
+
+def seconds_to_next_minute():
+    now = datetime.now()
+    return 60 - now.second - now.microsecond / 1_000_000
+
+def schedule_expiry(application):
+    # Слоты задаются с точностью до минуты, поэтому запускаемся в начале каждой минуты
+    application.job_queue.run_repeating(expire_bookings_job, interval=60, first=seconds_to_next_minute(),
+                                        name='expire_bookings')
+
+def schedule_outbox(application):
+    application.job_queue.run_once(drain_outbox_job, when=OUTBOX_TICK, name='drain_outbox')
+    if REMINDER_MINUTES:
+        application.job_queue.run_repeating(reminders_job, interval=60, first=seconds_to_next_minute(),
+                                            name='reminders')
+
+# Состояние диалога (шаг бронирования, выбранное время) хранится в таблице conversation_state,
+# чтобы пережить перезапуск и смену инстанса. Изменения копятся в памяти и пишутся
+# одной транзакцией раз в STATE_FLUSH_INTERVAL секунд и при остановке бота
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', '10'))
+
+@instrumented_db
+def load_state(kind, key_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT data FROM conversation_state WHERE kind = ? AND id = ?', (kind, key_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+@instrumented_db
+def save_state(changes):
+    """changes - список (kind, id, JSON или None - удалить запись)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    cursor.executemany('''
+        INSERT INTO conversation_state (kind, id, data, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (kind, id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+    ''', [(kind, key_id, data, now) for kind, key_id, data in changes if data is not None])
+    cursor.executemany('DELETE FROM conversation_state WHERE kind = ? AND id = ?',
+                       [(kind, key_id) for kind, key_id, data in changes if data is None])
+    conn.commit()
+
+class StateStore:
+    """user_data/chat_data в базе: запись читается при первом update пользователя (чата),
+    а не вся при старте; в буфер попадают только изменившиеся, последнее изменение побеждает"""
+    
+    def __init__(self, reload=False):
+        # reload - перечитывать запись на каждый update: в webhook-режиме её мог изменить другой инстанс
+        self.reload = reload
+        # (kind, id) -> JSON, который сейчас в базе (None - записи нет)
+        self._stored = {}
+        # (kind, id) -> JSON (или None), ещё не записанный в базу
+        self._pending = {}
+    
+    async def refresh(self, kind, key_id, data):
+        key = (kind, key_id)
+        # Несохранённые изменения новее базы
+        if key in self._pending or (key in self._stored and not self.reload):
+            return
+        payload = await db_read(load_state, kind, key_id)
+        self._stored[key] = payload
+        data.clear()
+        if payload is not None:
+            data.update(json.loads(payload))
+    
+    def update(self, kind, key_id, data):
+        key = (kind, key_id)
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'), sort_keys=True) if data else None
+        if payload != self._pending.get(key, self._stored.get(key)):
+            self._pending[key] = payload
+    
+    async def flush(self):
+        if not self._pending:
+            return
+        changes, self._pending = self._pending, {}
+        try:
+            await db_write(save_state, [(kind, key_id, data) for (kind, key_id), data in changes.items()])
+        except Exception:
+            # Не записалось - вернуть в буфер всё, что не успели заменить более новые изменения
+            for key, data in changes.items():
+                self._pending.setdefault(key, data)
+            raise
+        self._stored.update(changes)
+
+def make_persistence(store):
+    """BasePersistence поверх StateStore; telegram.ext импортируется здесь, а не при загрузке модуля"""
+    from telegram.ext import BasePersistence, PersistenceInput
+    
+    class StatePersistence(BasePersistence):
+        # Заранее ничего не загружаем: данные читаются в refresh_*_data перед обработчиками update
+        async def get_user_data(self):
+            return {}
+        
+        async def get_chat_data(self):
+            return {}
+        
+        async def get_bot_data(self):
+            return {}
+        
+        async def get_callback_data(self):
+            return None
+        
+        async def get_conversations(self, name):
+            return {}
+        
+        async def update_conversation(self, name, key, new_state):
+            pass
+        
+        async def update_bot_data(self, data):
+            pass
+        
+        async def update_callback_data(self, data):
+            pass
+        
+        async def refresh_bot_data(self, bot_data):
+            pass
+        
+        async def update_user_data(self, user_id, data):
+            store.update('user', user_id, data)
+        
+        async def update_chat_data(self, chat_id, data):
+            store.update('chat', chat_id, data)
+        
+        async def drop_user_data(self, user_id):
+            store.update('user', user_id, None)
+        
+        async def drop_chat_data(self, chat_id):
+            store.update('chat', chat_id, None)
+        
+        async def refresh_user_data(self, user_id, user_data):
+            await store.refresh('user', user_id, user_data)
+        
+        async def refresh_chat_data(self, chat_id, chat_data):
+            await store.refresh('chat', chat_id, chat_data)
+        
+        async def flush(self):
+            await store.flush()
+    
+    return StatePersistence(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                            update_interval=STATE_FLUSH_INTERVAL)
+
+async def flush_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """Собирает изменившиеся user_data/chat_data и пишет их одной транзакцией"""
+    await context.application.update_persistence()
+    await context.application.persistence.flush()
+
+def schedule_state_flush(application):
+    application.job_queue.run_repeating(flush_state_job, interval=STATE_FLUSH_INTERVAL, name='flush_state')
+
+# Сколько update обрабатывать одновременно; update одного пользователя - всегда по очереди
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '32'))
+# Сколько последних update_id и id callback-запросов помнить, чтобы повтор не обработать дважды
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', '10000'))
+
+class RecentIds:
+    """Ограниченное множество недавно встреченных id: самые старые вытесняются"""
+    
+    def __init__(self, size):
+        self.size = size
+        self._ids = OrderedDict()
+    
+    def seen(self, key):
+        """True, если key уже встречался; иначе запоминает его"""
+        if key in self._ids:
+            self._ids.move_to_end(key)
+            return True
+        self._ids[key] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return False
+
+def make_update_processor(max_concurrent):
+    """BaseUpdateProcessor с порядком по пользователям; telegram.ext импортируется здесь"""
+    from telegram.ext import BaseUpdateProcessor
+    
+    class UserOrderedProcessor(BaseUpdateProcessor):
+        """Update разных пользователей обрабатываются параллельно, одного - строго по очереди
+        (иначе два нажатия 'подтвердить' могли бы забронировать дважды).
+        Повторно доставленные update и callback-запросы пропускаются"""
+        
+        def __init__(self):
+            # process_update базового класса (final) держит семафор на всё время do_process_update,
+            # поэтому он заведомо не ограничивает: лимит max_concurrent - свой, после очереди пользователя
+            super().__init__(2 ** 31 - 1)
+            self.limit = max_concurrent
+            # Семафор создаётся при первом update - уже в цикле событий, где работает бот
+            self._slots = None
+            self._recent = RecentIds(UPDATE_DEDUP_SIZE)
+            # id пользователя (чата) -> [блокировка, сколько update её держат или ждут]
+            self._locks = {}
+        
+        def _is_duplicate(self, update):
+            if not isinstance(update, Update):
+                return False
+            if self._recent.seen(('update', update.update_id)):
+                return True
+            query = update.callback_query
+            return query is not None and self._recent.seen(('callback', query.id))
+        
+        async def _run(self, coroutine):
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(self.limit)
+            async with self._slots:
+                await coroutine
+        
+        async def do_process_update(self, update, coroutine):
+            if self._is_duplicate(update):
+                coroutine.close()
+                metrics.count('updates', 'duplicate')
+                logging.info(f"Повторный update пропущен: {update.update_id}")
+                return
+            # Лимит - до очереди пользователя и до refresh_user_data: отклонённый update не читает базу
+            if isinstance(update, Update) and await rate_limit(update):
+                coroutine.close()
+                return
+            
+            sender = (update.effective_user or update.effective_chat) if isinstance(update, Update) else None
+            if sender is None:
+                await self._run(coroutine)
+                return
+            
+            # Сначала очередь пользователя, потом общий семафор: ждущие своей очереди
+            # update не занимают места, нужные другим пользователям
+            entry = self._locks.setdefault(sender.id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self._run(coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[sender.id]
+        
+        async def initialize(self):
+            pass
+        
+        async def shutdown(self):
+            pass
+    
+    return UserOrderedProcessor()
+
+def application_builder(token=None):
+    from telegram.ext import Application
+    return Application.builder().token(token or BOT_TOKEN)
+
+def build_application(builder=None, reload_state=False):
+    """reload_state - перечитывать состояние диалога из базы на каждый update (webhook-режим)"""
+    from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, filters
+    
+    if builder is None:
+        builder = application_builder()
+    application = (
+        builder
+        .persistence(make_persistence(StateStore(reload=reload_state)))
+        .concurrent_updates(make_update_processor(CONCURRENT_UPDATES))
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("export", export))
     application.add_handler(CallbackQueryHandler(gender_selection, pattern="^gender_"))
+    application.add_handler(CallbackQueryHandler(facility_selection, pattern="^facility_"))
     application.add_handler(CallbackQueryHandler(confirm_booking, pattern="^confirm_"))
+    application.add_handler(CallbackQueryHandler(pick_suggested_slot, pattern="^pick_"))
     application.add_handler(CallbackQueryHandler(handle_cancel_confirmation, pattern="^cancel_"))
     application.add_handler(CallbackQueryHandler(handle_cancel_confirmation, pattern="^refresh_"))
+    application.add_handler(CallbackQueryHandler(schedule_page, pattern="^page_"))
     application.add_handler(CallbackQueryHandler(handle_cancel_confirmation, pattern="^book_from_list"))
     application.add_handler(CallbackQueryHandler(handle_cancel_confirmation, pattern="^back_to_menu"))
     application.add_handler(CallbackQueryHandler(handle_cancel_confirmation, pattern="^cancel_booking_process"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_main_menu))
     
-    application.run_polling()
+    return application
+
+# Webhook-режим: Application и цикл событий живут, пока жив тёплый инстанс
+_webhook_lock = threading.Lock()
+_webhook_loop = None
+_webhook_application = None
+
+def check_webhook_config():
+    """Webhook-режим без секрета или (на Vercel) без общей базы небезопасен - лучше не работать вовсе"""
+    if not BOT_TOKEN:
+        raise RuntimeError("Не задан BOT_TOKEN")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Не задан WEBHOOK_SECRET: без него любой может прислать поддельный update")
+    if os.environ.get('VERCEL') and not LIBSQL_URL:
+        raise RuntimeError(
+            "Не задан LIBSQL_URL: у каждого инстанса Vercel свой /tmp, "
+            "и брони в разных копиях базы будут пересекаться"
+        )
+
+def get_webhook_application():
+    global _webhook_loop, _webhook_application
+    if _webhook_application is None:
+        check_webhook_config()
+        init_db()
+        loop = asyncio.new_event_loop()
+        application = build_application(application_builder().updater(None).job_queue(None), reload_state=True)
+        loop.run_until_complete(application.initialize())
+        # Запоминаем текущую версию базы, чтобы дальше замечать чужие изменения
+        loop.run_until_complete(db_write(sync_external_changes))
+        _webhook_loop, _webhook_application = loop, application
+    return _webhook_loop, _webhook_application
+
+async def process_webhook_update(application, data):
+    update = Update.de_json(data, application.bot)
+    
+    async def handle():
+        # Между запросами инстанс может быть заморожен, поэтому job queue здесь не работает:
+        # истёкшие брони удаляем перед обработкой (без записи, если удалять нечего)
+        await db_write(sync_external_changes)
+        await db_write(cleanup_old_bookings)
+        await application.process_update(update)
+    
+    # Через update_processor: повторно доставленный после таймаута или сверх лимита update
+    # отклоняется ещё до синхронизации с базой
+    await application.update_processor.process_update(update, handle())
+    # Состояние диалога пишем сразу: до следующего запроса инстанс могут заморозить или остановить.
+    # Если update его не изменил, записи в базу нет
+    await application.update_persistence()
+    await application.persistence.flush()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics - метрики в формате Prometheus, любой другой GET - health-check"""
+    
+    def do_GET(self):
+        if self.path.split('?', 1)[0].rstrip('/').endswith('/metrics'):
+            if not METRICS_ENABLED:
+                self._reply(404)
+                return
+            self._reply(200, metrics.render_prometheus().encode(),
+                        'text/plain; version=0.0.4; charset=utf-8')
+            return
+        self._reply(200, b'ok')
+    
+    def _reply(self, status, body=b'', content_type='text/plain; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+class handler(MetricsHandler):
+    """Точка входа Vercel (см. vercel.json): один POST от Telegram - один Update.
+    GET /cron от Vercel Cron (раз в минуту) ставит напоминания и отправляет очередь outbox"""
+    
+    # Сколько секунд запрос cron может отправлять очередь
+    CRON_BUDGET = 5
+    
+    def do_GET(self):
+        if not self.path.split('?', 1)[0].rstrip('/').endswith('/cron'):
+            super().do_GET()
+            return
+        
+        if not CRON_SECRET or self.headers.get('Authorization') != f'Bearer {CRON_SECRET}':
+            self._reply(403)
+            return
+        
+        try:
+            with _webhook_lock:
+                loop, application = get_webhook_application()
+                sent = loop.run_until_complete(run_outbox_once(application.bot, self.CRON_BUDGET))
+        except Exception:
+            logging.exception("Ошибка при отправке очереди по cron")
+            self._reply(500)
+            return
+        self._reply(200, f'sent {sent}'.encode())
+    
+    def do_POST(self):
+        if not WEBHOOK_SECRET:
+            logging.error("WEBHOOK_SECRET не задан - webhook-запросы отклоняются")
+            self._reply(403)
+            return
+        if self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self._reply(403)
+            return
+        
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length))
+            with _webhook_lock:
+                loop, application = get_webhook_application()
+                loop.run_until_complete(process_webhook_update(application, data))
+        except Exception:
+            logging.exception("Ошибка при обработке webhook")
+        
+        # Отвечаем 200 даже при ошибке, иначе Telegram будет присылать тот же update снова
+        self._reply(200)
+
+async def log_metrics_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодический снимок метрик в лог"""
+    logging.info(f"Метрики: {json.dumps(metrics.snapshot(), ensure_ascii=False)}")
+
+def start_metrics_server(port):
+    from http.server import ThreadingHTTPServer
+    
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Метрики доступны на :{port}/metrics")
+
+async def set_webhook(url):
+    if not WEBHOOK_SECRET:
+        raise SystemExit("Задайте WEBHOOK_SECRET: без него handler отклоняет все webhook-запросы")
+    application = build_application(application_builder().updater(None).job_queue(None))
+    async with application:
+        await application.bot.set_webhook(url, secret_token=WEBHOOK_SECRET)
+    logging.info(f"Webhook установлен: {url}")
+
+def measure_startup():
+    """Замер холодного старта в миллисекундах: импорт модуля, init_db и сборка Application.
+    init_db выполняется на новой базе во временном каталоге - замер ничего не создаёт и не мигрирует"""
+    import shutil
+    import tempfile
+    
+    global db
+    timings = {'import_ms': IMPORT_SECONDS * 1000}
+    
+    workdir = tempfile.mkdtemp(prefix='shower_startup_')
+    db, real_db = ConnectionManager(os.path.join(workdir, 'startup.db')), db
+    try:
+        started = time.perf_counter()
+        init_db()
+        timings['init_db_ms'] = (time.perf_counter() - started) * 1000
+    finally:
+        db.close_all()
+        db = real_db
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    started = time.perf_counter()
+    # Bot API при сборке не вызывается, поэтому без BOT_TOKEN подойдёт любой токен
+    build_application(application_builder(BOT_TOKEN or '0:startup').updater(None).job_queue(None))
+    timings['build_application_ms'] = (time.perf_counter() - started) * 1000
+    
+    timings['total_ms'] = sum(timings.values())
+    return timings
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Бот бронирования душа")
+    parser.add_argument('--set-webhook', metavar='URL',
+                        help="зарегистрировать webhook (например, адрес деплоя на Vercel) и выйти")
+    parser.add_argument('--startup-time', action='store_true',
+                        help="вывести замер времени холодного старта в JSON и выйти")
+    parser.add_argument('--max-startup-ms', type=float,
+                        help="с --startup-time: завершиться с кодом 1, если старт дольше (для CI)")
+    parser.add_argument('--export', choices=sorted(EXPORTS),
+                        help="вывести архив броней или сводку загрузки в stdout и выйти")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv',
+                        help="формат для --export (по умолчанию csv)")
+    args = parser.parse_args()
+    
+    if not BOT_TOKEN and not (args.startup_time or args.export):
+        raise SystemExit("Не задан BOT_TOKEN")
+    
+    if args.set_webhook:
+        asyncio.run(set_webhook(args.set_webhook))
+        return
+    
+    if args.startup_time:
+        timings = measure_startup()
+        print(json.dumps({k: round(v, 1) for k, v in timings.items()}))
+        if args.max_startup_ms is not None and timings['total_ms'] > args.max_startup_ms:
+            raise SystemExit(1)
+        return
+    
+    if args.export:
+        import sys
+        
+        init_db()
+        export_data(args.export, args.format, sys.stdout)
+        return
+    
+    init_db()
+    cleanup_old_bookings()
+    
+    application = build_application()
+    schedule_expiry(application)
+    schedule_outbox(application)
+    schedule_state_flush(application)
+    
+    if METRICS_ENABLED:
+        if METRICS_LOG_INTERVAL:
+            application.job_queue.run_repeating(log_metrics_job, interval=METRICS_LOG_INTERVAL,
+                                                name='log_metrics')
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+    
+    try:
+        application.run_polling()
+    finally:
+        db_executor.shutdown()
+        db.close_all()
+
+IMPORT_SECONDS = time.perf_counter() - _module_load_started
 
 if __name__ == '__main__':
     main()
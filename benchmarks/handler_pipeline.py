@@ -0,0 +1,340 @@
+"""Нагрузочный прогон обработчиков бота без сети.
+
+Синтетические пользователи проходят весь сценарий
+start -> gender_selection -> бронирование (ввод времени, confirm_booking) ->
+все брони -> мои брони -> отмена, а исходящие вызовы Bot API
+перехватывает FakeRequest и только записывает их.
+
+Запуск:
+    python benchmarks/handler_pipeline.py --users 10,100,500 --bookings 0,1000,2500
+
+Для каждой комбинации выводятся updates/sec, p50/p99 задержки по
+обработчикам, число SQL-выражений и вызовов Bot API на один update,
+а также сколько пользователей забронировали и сколько получили отказ.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# База создаётся во временном каталоге, до импорта бота (путь читается при импорте)
+_workdir = tempfile.mkdtemp(prefix='shower_bench_')
+os.environ['DB_PATH'] = os.path.join(_workdir, 'bench.db')
+# Синтетические пользователи шлют update без пауз - ограничение частоты их бы отсекло
+os.environ.setdefault('RATE_LIMIT_RATE', '0')
+os.environ.setdefault('RATE_LIMIT_ACTION_RATE', '0')
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+import index as bot  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+CANCEL_RE = re.compile(r'"callback_data":\s*"(cancel_\d+)"')
+
+
+class Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sql = 0
+        self.api = 0
+    
+    def add_sql(self, _statement):
+        with self._lock:
+            self.sql += 1
+    
+    def add_api(self):
+        with self._lock:
+            self.api += 1
+    
+    def reset(self):
+        with self._lock:
+            self.sql = self.api = 0
+
+
+counters = Counters()
+
+
+def _trace_connections():
+    """Считает все SQL-выражения, выполненные соединениями бота"""
+    connect = bot.db._connect
+    
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(counters.add_sql)
+        return conn
+    
+    bot.db._connect = traced_connect
+
+
+class FakeRequest(BaseRequest):
+    """Вместо HTTP к Telegram записывает вызов и возвращает правдоподобный ответ"""
+    
+    _message_ids = itertools.count(1)
+    
+    def __init__(self):
+        self.last_markup = {}
+        self.last_text = {}
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        else:
+            counters.add_api()
+            chat_id = params.get('chat_id', 0)
+            if 'reply_markup' in params:
+                self.last_markup[chat_id] = params['reply_markup']
+            if 'text' in params:
+                self.last_text[chat_id] = params['text']
+            if endpoint in ('sendMessage', 'editMessageText'):
+                result = {
+                    'message_id': next(self._message_ids), 'date': 0,
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'text': params.get('text', ''),
+                }
+            else:
+                result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    _ids = itertools.count(1)
+    
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    
+    def message(self, user_id, text):
+        update_id = next(self._ids)
+        message = {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id), 'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return {'update_id': update_id, 'message': message}
+    
+    def callback(self, user_id, data):
+        update_id = next(self._ids)
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id), 'chat_instance': str(user_id), 'data': data,
+                'from': self._user(user_id),
+                'message': {
+                    'message_id': update_id, 'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'},
+                    'text': '',
+                },
+            },
+        }
+
+
+def plan_targets(users):
+    """Время и пол для каждого синтетического пользователя: [(минута от начала завтрашнего дня, пол)].
+    
+    Окна по BOOKING_DURATION не пересекаются; в окне по пользователю на кабинку
+    и один пол на всех, так что confirm_booking проходит по успешному пути.
+    Если окон на горизонте не хватает, лишние пользователи получат отказ"""
+    facility = bot.DEFAULT_FACILITY
+    windows = bot.BOOKING_DAYS_AHEAD * 24 * 60 // bot.BOOKING_DURATION
+    needed = -(-users // len(facility.cabins))
+    starts = sorted(random.sample(range(windows), min(needed, windows)))
+    genders = [random.choice(['male', 'female']) for _ in starts]
+    return [
+        (starts[k] * bot.BOOKING_DURATION, genders[k])
+        for k in (i // len(facility.cabins) % len(starts) for i in range(users))
+    ]
+
+
+def seed_bookings(count, targets):
+    """Очищает базу и заполняет bookings чужими бронями, чтобы проверить рост таблицы.
+    Посевные брони не пересекаются со временем из targets"""
+    conn = bot.get_db_connection()
+    conn.execute('DELETE FROM bookings')
+    conn.execute('DELETE FROM users')
+    
+    # Каждое занятое время целиком отдаётся одному посевному пользователю,
+    # чтобы посев не нарушал правило "один пол на время". Брони разбросаны
+    # по всему горизонту бронирования, начиная с завтрашнего дня
+    days = bot.BOOKING_DAYS_AHEAD
+    duration = bot.BOOKING_DURATION
+    tomorrow = datetime.now().date() + timedelta(days=1)
+    facility = bot.DEFAULT_FACILITY
+    reserved = set()
+    for start, _ in targets:
+        reserved.update(range(start - duration + 1, start + duration))
+    free = [moment for moment in range(days * 24 * 60) if moment not in reserved]
+    slots_needed = -(-count // len(facility.cabins))
+    moments = random.sample(free, min(slots_needed, len(free)))
+    users, rows = [], []
+    for i, moment in enumerate(moments):
+        user_id = 10_000_000 + i
+        date = (tomorrow + timedelta(days=moment // (24 * 60))).isoformat()
+        users.append((user_id, random.choice(['male', 'female']), f'Seed {i}'))
+        for cabin in facility.cabins:
+            if len(rows) < count:
+                rows.append((user_id, facility.id, date, moment % (24 * 60), duration, cabin))
+    conn.executemany('INSERT INTO users (user_id, gender, name) VALUES (?, ?, ?)', users)
+    conn.executemany(
+        'INSERT INTO bookings (user_id, facility, date, slot, duration, cabin_number) VALUES (?, ?, ?, ?, ?, ?)',
+        rows
+    )
+    conn.commit()
+    bot.invalidate_occupancy()
+    return len(rows)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def user_session(application, request, factory, user_id, target, latencies, outcomes):
+    async def send(label, payload):
+        started = time.perf_counter()
+        await application.process_update(Update.de_json(payload, application.bot))
+        latencies.setdefault(label, []).append(time.perf_counter() - started)
+    
+    moment, gender = target
+    when = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+    when += timedelta(minutes=moment)
+    
+    await send('start', factory.message(user_id, '/start'))
+    await send('gender_selection', factory.callback(user_id, f'gender_{gender}'))
+    await send('start_booking', factory.message(user_id, '🚿 Забронировать душ'))
+    await send('handle_time_input', factory.message(user_id, when.strftime('%d.%m %H:%M')))
+    await send('confirm_booking', factory.callback(user_id, 'confirm_1'))
+    booked = request.last_text.get(user_id, '').startswith('✅')
+    outcomes['booked' if booked else 'rejected'] += 1
+    await send('show_all_bookings', factory.message(user_id, '📊 Все бронирования'))
+    await send('show_my_bookings', factory.message(user_id, '📋 Мои брони'))
+    await send('cancel_booking_menu', factory.message(user_id, '❌ Отменить бронь'))
+    
+    markup = request.last_markup.get(user_id, '')
+    if not isinstance(markup, str):
+        markup = json.dumps(markup)
+    match = CANCEL_RE.search(markup)
+    if match:
+        await send('cancel_booking', factory.callback(user_id, match.group(1)))
+
+
+async def run_scenario(users, bookings, concurrency):
+    from telegram.ext import Application
+    
+    request = FakeRequest()
+    builder = Application.builder().token('1:bench').request(request).get_updates_request(request)
+    application = bot.build_application(builder.updater(None).job_queue(None))
+    targets = plan_targets(users)
+    seeded = seed_bookings(bookings, targets)
+    
+    factory = UpdateFactory()
+    latencies = {}
+    outcomes = {'booked': 0, 'rejected': 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    first_user = 1_000 + users * 1_000
+    
+    async def limited(user_id, target):
+        async with semaphore:
+            await user_session(application, request, factory, user_id, target, latencies, outcomes)
+    
+    async with application:
+        counters.reset()
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(first_user + i, target) for i, target in enumerate(targets)))
+        elapsed = time.perf_counter() - started
+    
+    updates = sum(len(v) for v in latencies.values())
+    return {
+        'users': users,
+        'bookings': seeded,
+        'updates': updates,
+        'booked': outcomes['booked'],
+        'rejected': outcomes['rejected'],
+        'updates_per_sec': updates / elapsed if elapsed else 0.0,
+        'sql_per_update': counters.sql / updates if updates else 0.0,
+        'api_calls_per_update': counters.api / updates if updates else 0.0,
+        'handlers': {
+            label: {
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+            }
+            for label, values in latencies.items()
+        },
+    }
+
+
+def print_report(result):
+    print(f"\nusers={result['users']} bookings={result['bookings']}: "
+          f"{result['updates']} updates, {result['updates_per_sec']:.0f} updates/sec, "
+          f"{result['sql_per_update']:.1f} SQL/update, "
+          f"{result['api_calls_per_update']:.2f} Bot API calls/update, "
+          f"{result['booked']} booked, {result['rejected']} rejected")
+    print(f"  {'handler':<22} {'p50, ms':>9} {'p99, ms':>9}")
+    for label, stats in result['handlers'].items():
+        print(f"  {label:<22} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=_int_list, default=[10, 100, 500],
+                        help="число пользователей через запятую (по умолчанию 10,100,500)")
+    parser.add_argument('--bookings', type=_int_list, default=[0, 1000, 2500],
+                        help="размер таблицы bookings перед прогоном (по умолчанию 0,1000,2500)")
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help="сколько пользователей проходят сценарий одновременно")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    args = parser.parse_args()
+    
+    random.seed(args.seed)
+    _trace_connections()
+    bot.init_db()
+    
+    results = []
+    for bookings in args.bookings:
+        for users in args.users:
+            result = asyncio.run(run_scenario(users, bookings, args.concurrency))
+            results.append(result)
+            if not args.json:
+                print_report(result)
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+    
+    bot.db_executor.shutdown()
+    bot.db.close_all()
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
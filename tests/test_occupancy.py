@@ -0,0 +1,85 @@
+"""Проверки занятости кабинок на отдельной временной базе"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# База создаётся во временном каталоге, до импорта бота (путь читается при импорте)
+_workdir = tempfile.mkdtemp(prefix='shower_test_')
+os.environ['DB_PATH'] = os.path.join(_workdir, 'test.db')
+os.environ.pop('LIBSQL_URL', None)
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+import index as bot  # noqa: E402
+
+
+def tearDownModule():
+    bot.db_executor.shutdown()
+    bot.db.close_all()
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+class OccupancyTest(unittest.TestCase):
+    def setUp(self):
+        bot.init_db()
+        conn = bot.get_db_connection()
+        conn.execute('DELETE FROM bookings')
+        conn.execute('DELETE FROM users')
+        conn.commit()
+        bot.user_cache.clear()
+        bot.invalidate_occupancy()
+        self.facility = bot.DEFAULT_FACILITY
+        self.date = (datetime.now().date() + timedelta(days=1)).isoformat()
+    
+    def book(self, user_id, gender, slot, cabins_count=1):
+        bot.save_user(user_id, gender, f'User{user_id}')
+        return bot.book_cabins(user_id, self.facility.id, self.date, slot, bot.BOOKING_DURATION, cabins_count)
+    
+    def test_gender_of_every_overlapping_interval(self):
+        # В кабинке 1 подряд мужская 14:00 и женская 14:15 брони: 14:10 задевает обе
+        self.assertEqual(self.book(1, 'male', 14 * 60), [1])
+        self.assertEqual(self.book(2, 'female', 14 * 60 + 15), [1])
+        
+        bot.save_user(3, 'male', 'User3')
+        slot = 14 * 60 + 10
+        mask, gender = self.facility.occupancy.busy(self.date, slot, bot.BOOKING_DURATION)
+        self.assertEqual(gender, bot.MIXED_GENDERS)
+        # Проверка доступности должна совпадать с транзакцией бронирования
+        self.assertEqual(bot.check_availability(self.facility.id, self.date, slot, bot.BOOKING_DURATION, 3), 0)
+        self.assertEqual(bot.book_cabins(3, self.facility.id, self.date, slot, bot.BOOKING_DURATION, 1), [])
+    
+    def test_cancel_refreshes_schedule_cached_before_index_load(self):
+        self.assertEqual(self.book(1, 'male', 14 * 60), [1])
+        booking_id = bot.get_db_connection().execute('SELECT id FROM bookings').fetchone()[0]
+        # Расписание кэшируется, пока индекс сброшен (например, после регистрации)
+        self.facility.occupancy.invalidate()
+        pages = asyncio.run(bot.get_schedule_pages(self.facility, 'title', 'icon'))
+        self.assertIsNotNone(pages)
+        
+        bot.delete_booking(booking_id)
+        self.assertIsNone(asyncio.run(bot.get_schedule_pages(self.facility, 'title', 'icon')))
+    
+    def test_save_user_invalidates_only_when_bookings_change(self):
+        self.assertEqual(self.book(1, 'male', 14 * 60), [1])
+        self.facility.occupancy.busy(self.date, 14 * 60, bot.BOOKING_DURATION)
+        version = self.facility.occupancy.version
+        
+        # Регистрация нового пользователя и повтор того же выбора индекс не сбрасывают
+        bot.save_user(2, 'female', 'User2')
+        bot.save_user(1, 'male', 'User1')
+        self.assertEqual(self.facility.occupancy.version, version)
+        
+        # Смена пола меняет метку уже существующей брони
+        bot.save_user(1, 'female', 'User1')
+        self.assertGreater(self.facility.occupancy.version, version)
+        _, gender = self.facility.occupancy.busy(self.date, 14 * 60, bot.BOOKING_DURATION)
+        self.assertEqual(gender, 'female')
+
+
+if __name__ == '__main__':
+    unittest.main()